@@ -3,8 +3,8 @@ from automl.preprocessing.preprocess_utils import *
 from automl.modeling.modeling import *
 import logging
 import sys
-import random
 from automl.dev_tools import *
+from automl.profiler import load_profile
 
 
 class AutoML:
@@ -23,34 +23,91 @@ class AutoML:
         self.problem = problem
         self._X_return = None
 
-    def create_panel(self, test=True):
+    def create_panel(self, test=True, streaming=False, spark=False, parallel=False):
         """
         create data panel
+        :param streaming: if true the transactions are read and processed in chunks of raw_data chunk_size rows
+        instead of being loaded to memory at once
+        :param spark: if true the panel is created with spark dataframes on the executors and is never collected to
+        the driver
+        :param parallel: if true the accounts are split between raw_data n_jobs processes
         """
         params = json.loads(open("automl/params.json", "rb").read())
         get_data_params = params["raw_data"]
-        if not test:
-            data = get_data()
+        if not test and spark:
+            from automl.preprocessing.spark_panel import spark_get_data, spark_dates_table, \
+                spark_feature_engineering_transactions, spark_clean_and_join_other_data, spark_join_data_final
+            data = spark_get_data(self.session, os.getcwd() + "/raw_data")
+            logging.info("Data tables loaded: " + " ".join(list(data.keys())))
+            dates_df = spark_dates_table(self.session, get_data_params["start_date"], get_data_params["end_date"])
+            trans_df = spark_feature_engineering_transactions(data["trans_train"], dates_df, get_data_params["ma_periods"])
+            df = spark_clean_and_join_other_data(data)
+            spark_df_joined = spark_join_data_final(df, trans_df, data)
+            spark_df_joined.createOrReplaceTempView(params["raw_data"]["raw_data_name"])
+            logging.info("Final joined spark df created with " + str(len(spark_df_joined.columns)) + " columns")
+        elif not test:
+            data = get_data(exclude=["trans_train"] if streaming else [])
             logging.info("Data tables loaded: " + " ".join(list(data.keys())))
             dates_df = create_dates_table(get_data_params["start_date"], get_data_params["end_date"])
             logging.info("Dates table loaded with " + get_data_params["start_date"] + " to " + get_data_params["end_date"] + " and in shape of " + str(dates_df.shape))
-            trans_df = feature_engineering_transactions(data["trans_train"], dates_df)
-            logging.info("Trans table feature engineering complete with shape of" + str(trans_df.shape))
-            df = clean_and_join_other_data(data)
-            logging.info("Main df table feature engineering complete with shape of" + str(df.shape))
-            df_joined = join_data_final(df, trans_df, data)
+            if parallel and not streaming:
+                df_joined = create_panel_parallel(data, dates_df, get_data_params["ma_periods"], get_data_params["n_jobs"])
+            elif streaming:
+                output_dir = feature_engineering_transactions_streaming(os.getcwd() + "/raw_data/trans_train.csv",
+                                                                        dates_df, os.getcwd() + "/trans_features",
+                                                                        get_data_params["ma_periods"],
+                                                                        get_data_params["chunk_size"])
+                trans_df = read_tables(output_dir)
+            else:
+                trans_df = feature_engineering_transactions(data["trans_train"], dates_df, get_data_params["ma_periods"])
+            if not parallel or streaming:
+                logging.info("Trans table feature engineering complete with shape of" + str(trans_df.shape))
+                df = clean_and_join_other_data(data)
+                logging.info("Main df table feature engineering complete with shape of" + str(df.shape))
+                df_joined = join_data_final(df, trans_df, data)
             logging.info("Final joined df complete with shape of" + str(df_joined.shape))
-            spark_df_joined = self.session.createDataFrame(df_joined)
+            df_joined = compact_dtypes(df_joined)
+            # the stored panel is the base of the next refresh_panel
+            write_table(df_joined, os.getcwd() + "/" + get_data_params["panel_path"])
+            from automl.preprocessing.spark_utils import to_spark
+            spark_df_joined = to_spark(self.session, df_joined, batch_size=params["arrow_batch_size"])
             spark_df_joined.createOrReplaceTempView(params["raw_data"]["raw_data_name"])
         else:
             spark_df_joined = self.session.read.option("header", "true").csv("test/df_joined.csv")
             spark_df_joined.createOrReplaceTempView(params["raw_data"]["raw_data_name"])
 
+    def refresh_panel(self, cutoff_date, trans_path):
+        """
+        refresh the stored data panel with new transactions, only the months from cutoff_date on are computed again
+        :param cutoff_date: the first day of the first month to compute again, for example "1997-12-01" - string
+        :param trans_path: csv of all the transactions dated on or after cutoff_date - string
+        """
+        params = json.loads(open("automl/params.json", "rb").read())
+        get_data_params = params["raw_data"]
+        panel_path = os.getcwd() + "/" + get_data_params["panel_path"]
+        df_joined = read_table(panel_path)
+        data = get_data(exclude=["trans_train"])
+        df_trans_new = pd.read_csv(trans_path, sep=";")
+        df_trans_new.columns = [col.strip() for col in df_trans_new.columns]
+        logging.info("New transactions loaded with shape of " + str(df_trans_new.shape))
+        dates_df = create_dates_table(get_data_params["start_date"], get_data_params["end_date"])
+        df_joined = refresh_panel(df_joined, df_trans_new, data, dates_df, cutoff_date, get_data_params["ma_periods"])
+        df_joined = compact_dtypes(df_joined)
+        logging.info("Final joined df refreshed with shape of" + str(df_joined.shape))
+        write_table(df_joined, panel_path)
+        from automl.preprocessing.spark_utils import to_spark
+        spark_df_joined = to_spark(self.session, df_joined, batch_size=params["arrow_batch_size"])
+        spark_df_joined.createOrReplaceTempView(params["raw_data"]["raw_data_name"])
+
     def get_raw_data(self):
 
         return self.session.sql("select * from spark_df_joined")
 
-    def preprocess_data(self, only_one_return=True):
+    def preprocess_data(self, only_one_return=True, spark=False):
+        """
+        :param spark: if the preprocessed data is also saved as tables of the spark catalog, for
+        get_data_after_preprocess with spark
+        """
 
         os.chdir(os.path.dirname(os.path.realpath(__file__)))
         params = json.loads(open("params.json").read())
@@ -63,56 +120,57 @@ class AutoML:
         # df = self.session.sql("select * from spark_df_joined").toPandas()
         # df = pd.read_csv('C:\\Users\\Administrator\\PycharmProjects\\automl\\test\\df_joined.csv').head(10000)
         df = pd.read_csv('C:\\Users\\Administrator\\PycharmProjects\\automl\\test\\df_joined.csv')
-        columns = get_cols(df, key_cols + target_cols + exclude_cols, cols_per)
+        # only the numerics are compacted, the transformers expect the categorical columns as strings
+        df = compact_dtypes(df, {col: dtype for col, dtype in plan_dtypes(df).items() if dtype != "category"})
+        if params["columns_profile"]:
+            # the types of the whole panel from its profile, see automl.profiler, instead of a sample of df
+            columns = get_cols_from_profile(load_profile(params["columns_profile"]), key_cols + target_cols + exclude_cols,
+                                            cols_per)
+        else:
+            columns = get_cols_cached(df, key_cols + target_cols + exclude_cols, cols_per, hash_sample=True)
         logging.info("finish get cols")
         columns["key"] = key_cols
-        json.dump(columns, open("columns_type_mapping.json", "w"))
+        # the mapping is written only when it changed
+        if not os.path.exists("columns_type_mapping.json") or json.loads(open("columns_type_mapping.json").read()) != columns:
+            json.dump(columns, open("columns_type_mapping.json", "w"))
         X_return = []
+        # the accounts are split once by their hash, the same for all the problems and runs
+        train_rows, test_rows = split_by_key(df[key_cols[0]], params["train_test_per"], params["split_seed"])
+        df = df.set_index(key_cols)
+        # the stages that don't use the target are fitted and applied once for all the problems
+        prefix_time = time.time()
+        prefix = features_prefix(columns, key=key_cols[0], date=key_cols[1])
+        X_train = prefix.fit_transform(df[columns["numeric"] + columns["categoric"]].iloc[train_rows])
+        X_test = prefix.transform(df[columns["numeric"] + columns["categoric"]].iloc[test_rows])
+        prefix_time = time.time() - prefix_time
         for i, p in enumerate(problems):
             columns["target"] = [p["target"]]
-            accounts_train, accounts_test = [], []
-            for account in df[key_cols[0]].unique():
-                rand = random.random()
-                if rand < params["train_test_per"]:
-                    accounts_train.append(account)
-                else:
-                    accounts_test.append(account)
-            df_train = df[df[key_cols[0]].isin(accounts_train)].set_index(key_cols)[
-                columns["numeric"] + columns["categoric"] + columns["target"]]
-            df_test = df[df[key_cols[0]].isin(accounts_test)].set_index(key_cols)[
-                columns["numeric"] + columns["categoric"] + columns["target"]]
-            X_train = df_train.drop(p["target"], axis=1)
-            y_train = df_train[p["target"]]
-            X_test = df_test.drop(p["target"], axis=1)
-            y_test = df_test[p["target"]]
-            x = features_pipeline(i, X_train, y_train, X_test, y_test, columns, p, self.session, key=key_cols[0], date=key_cols[1])
+            y_train = df[p["target"]].iloc[train_rows]
+            y_test = df[p["target"]].iloc[test_rows]
+            x = features_pipeline(i, X_train, y_train, X_test, y_test, columns, p, self.session, key=key_cols[0],
+                                  date=key_cols[1], prefix=prefix, prefix_time=prefix_time / len(problems),
+                                  spark_store=spark)
             X_return.append(x)
             if only_one_return:
                 return X_return
         self._X_return = X_return
         return X_return
 
-    def get_data_after_preprocess(self, row, spark=False):
+    def get_data_after_preprocess(self, row, spark=False, columns=None):
         """
-
+        :param spark: if the data is read from the spark catalog tables written by preprocess_data with spark
+        :param columns: the features to read from the spark tables, default: all of them
         """
         path = os.path.dirname(__file__)
         params = json.loads(open(path + "/params.json").read())
         key_cols = params["key_cols"]
 
         if spark:
-            X_train = self.session.sql("select * from preprocess_results.X_train_{}".format(row["target"]))
-            y_train = self.session.sql("select * from preprocess_results.y_train_{}.csv".format(row["target"]))
-            X_test = self.session.sql("select * from preprocess_results.X_test_{}.csv".format(row["target"]))
-            y_test = self.session.sql("select * from preprocess_results.y_test_{}.csv".format(row["target"]))
+            from automl.preprocessing.spark_utils import spark_read_preprocess_results
+            X_train, y_train, X_test, y_test = spark_read_preprocess_results(self.session, row["target"], key_cols, columns,
+                                                                             batch_size=params["arrow_batch_size"])
         else:
-            X_train = pd.read_csv(path + "/preprocess_results/X_train_{}.csv".format(row["target"]))
-            y_train = pd.read_csv(path + "/preprocess_results/y_train_{}.csv".format(row["target"])).values.flatten()
-            X_test = pd.read_csv(path + "/preprocess_results/X_test_{}.csv".format(row["target"]))
-            y_test = pd.read_csv(path + "/preprocess_results/y_test_{}.csv".format(row["target"])).values.flatten()
-
-        X_train = X_train.set_index(key_cols)
-        X_test = X_test.set_index(key_cols)
+            X_train, y_train, X_test, y_test = read_preprocess_results(row["target"], key_cols, path + "/preprocess_results")
 
         return X_train, y_train, X_test, y_test
 
@@ -149,9 +207,13 @@ class AutoML:
                 m = len(self._X_return)
             x = self._X_return[min([i, max([m - 1, 0])])]
             X_train, y_train, X_test, y_test = self.get_data_after_preprocess(p)
+            # one float32 memory mapped matrix per problem, shared by all the models, folds and workers
+            columns = X_train.columns
+            X_train = float32_matrix(X_train, "preprocess_results/matrix/X_train_{}.npy".format(p["target"]))
+            X_test = float32_matrix(X_test, "preprocess_results/matrix/X_test_{}.npy".format(p["target"]))
             x = (x[0], x[1], X_train, y_train, X_test, y_test, x[2], x[3])
             for index, model in enumerate(models):
-                models_2_run = [(x[1], model, params["hyperparameters"][p["type"]][models_names[index]], x[2], x[3], x[4], x[5], models_names[index], x[6], p["type"])]
+                models_2_run = [(x[1], model, params["hyperparameters"][p["type"]][models_names[index]], x[2], x[3], x[4], x[5], models_names[index], x[6], p["type"], columns)]
                 results = [model_pipeline_run_unpack(x) for x in models_2_run]
                 folder = p["target"]
                 path = os.path.dirname(os.path.realpath(__file__))
@@ -5,6 +5,8 @@ from tensorflow.compat.v1.keras import backend as K
 import json
 import io
 import joblib
+import logging
+import hashlib
 
 
 def recall_m(y_true, y_pred):
@@ -69,52 +71,123 @@ def series_to_supervised(data, w=5, r=1, dropnan=True, target=None, cols_remove=
     return agg
 
 
-def is_date(df, col, string_ratio=0.02):
+def _date_failures(values):
     """
-    check if a column in a dataframe is a date or not
+    :param values: the unique values of a column - numpy array
+    :return: the number of values that can't be parsed as a date - int
+    """
+    try:
+        return int(pd.to_datetime(pd.Series(values, dtype=object), errors="coerce").isna().sum())
+    except Exception:
+        # the bulk parse can fail on mixed types, then every value is parsed by itself
+        failures = 0
+        for value in values:
+            try:
+                pd.Timestamp(value)
+            except Exception:
+                failures += 1
+        return failures
+
+
+def _sample_rows(df, sample_size=None, random_state=0):
+    """
+    :param df: the dataframe - Dataframe
+    :param sample_size: the number of rows to sample, default: no sample - int
+    :param random_state: the seed of the sample - int
+    :return: the sampled rows or None if the dataframe is not larger than the sample - Dataframe
+    """
+    if sample_size is None or df.shape[0] <= sample_size:
+        return None
+    rows = np.random.RandomState(random_state).choice(df.shape[0], sample_size, replace=False)
+    return df.iloc[np.sort(rows)]
+
+
+def _is_date(values, sample=None, string_ratio=0.02):
+    """
+    :param values: the column - Series
+    :param sample: sampled rows of the column, the column is parsed only if the sample is not clear - Series
+    :param string_ratio: the ratio of values that can't be parsed that makes the column not a date - float
+    :return: if the column is a date or not - boolean
+    """
+    if sample is not None:
+        sample = sample.astype(object).fillna(0).unique()
+        failures = _date_failures(sample)
+        if failures == 0:
+            return True
+        if (failures + 1) / len(sample) >= 2 * string_ratio:
+            return False
+    value_list = values.astype(object).fillna(0).unique()
+    failures = _date_failures(value_list)
+    return failures == 0 or (failures + 1) / len(value_list) < string_ratio
+
+
+def is_date(df, col, string_ratio=0.02, sample_size=None, random_state=0):
+    """
+    check if a column in a dataframe is a date or not, the unique values are parsed in bulk. with sample_size the
+    decision is taken on a sample of the rows when it is clear and the whole column is checked only when it is not
     :param df: the dataframe to check if it's ok - Dataframe
     :param col: the column to operate over - string
     :param string_ratio: the ratio that deside if there failed attempts / size of vector percentage larger than ratio
     than the feature is not a date - float
+    :param sample_size: the number of rows to decide on, default: all the rows - int
+    :param random_state: the seed of the sample - int
     :return: if the column is a date or not - boolearn
     """
-    count = 1
-    try:
-        value_list = df[col].fillna(0).unique().tolist()
-    except Exception as e:
-        print(df[col])
-        print(e)
-        print(col)
+    sample = _sample_rows(df[[col]], sample_size, random_state)
+    return _is_date(df[col], None if sample is None else sample[col], string_ratio)
 
-    for value in value_list:
-        try:
-            pd.Timestamp(value)
-        except Exception as e:
-            count += 1
-            if count / len(value_list) >= string_ratio:
-                return False
 
-    return True
+def _is_categoric(values, ratio, sample=None):
+    """
+    checks if the number of unique values in a column is at most ratio * the size of the column. with a sample the
+    number of unique values is estimated from it (chao1 estimator), and the whole column is scanned only when the
+    estimate is not clearly below or above the limit
+    :param values: the column - Series
+    :param ratio: the ratio of unique values - float
+    :param sample: sampled rows of the column - Series
+    :return: if the column is categoric - boolean
+    """
+    limit = ratio * values.shape[0]
+    if sample is not None:
+        counts = sample.value_counts(dropna=False)
+        if counts.shape[0] > limit:
+            return False
+        singles, doubles = (counts == 1).sum(), (counts == 2).sum()
+        if doubles > 0:
+            estimate = counts.shape[0] + singles * singles / (2. * doubles)
+        else:
+            estimate = counts.shape[0] + singles * (singles - 1) / 2.
+        if estimate <= limit / 2:
+            return True
+        if estimate >= limit * 2:
+            return False
+    return pd.unique(values).shape[0] <= limit
 
 
-def get_cols(df, exclude=[], ratio=0.1, key_cols=[]):
+def get_cols(df, exclude=[], ratio=0.1, key_cols=[], sample_size=10000, random_state=0):
     """
     finds the different types of features automatically
     :param df: the dataframe to check for columns - Dataframe
     :param exclude: columns to ignore - list of strings
     :param ratio: this ratio decide if a numeric column is actually categoric if the number of unique values in the
     feature divided by the size of feature is less than the ratio - float
+    :param sample_size: the number of rows the types are inferred from, ambiguous columns are checked on all the rows,
+    None to always use all the rows - int
+    :param random_state: the seed of the sample - int
     :return: dictionary with keys as columns types and values that are lists of strings with column names - dictionary
     """
     key_cols = [col for col in df.columns.tolist() if "_id" in col.lower()] + key_cols
-    cat_cols = df.select_dtypes(include=["object", "bool"]).columns.tolist()
-    date_cols = [col for col in cat_cols if col not in exclude + key_cols and is_date(df, col)]
+    # one sample of the rows for all the columns
+    sample = _sample_rows(df, sample_size, random_state)
+    cat_cols = df.select_dtypes(include=["object", "bool", "category"]).columns.tolist()
+    date_cols = [col for col in cat_cols if col not in exclude + key_cols and
+                 _is_date(df[col], None if sample is None else sample[col])]
     cat_cols = [col for col in cat_cols if col not in date_cols + key_cols + exclude]
     numeric_cols = [col for col in df.columns.tolist() if col not in key_cols + date_cols + cat_cols + exclude]
 
     for col in numeric_cols:
         try:
-            if df[col].unique().shape[0] <= ratio * df.shape[0]:
+            if _is_categoric(df[col], ratio, None if sample is None else sample[col]):
                 cat_cols.append(col)
         except Exception as e:
             print(e)
@@ -124,6 +197,172 @@ def get_cols(df, exclude=[], ratio=0.1, key_cols=[]):
     return {"key": key_cols, "categoric": cat_cols, "date": date_cols, "numeric": numeric_cols}
 
 
+def get_cols_from_profile(profile, exclude=[], ratio=0.1, key_cols=[]):
+    """
+    get_cols from the profile of a table (see automl.profiler) so the table doesn't need to be in memory
+    :param profile: the profile of the columns, in the order of the table - dictionary
+    :param exclude: columns to ignore - list of strings
+    :param ratio: this ratio decide if a numeric column is actually categoric if the number of distinct values in the
+    feature divided by the size of feature is less than the ratio - float
+    :param key_cols: key columns that are added to the _id columns - list of strings
+    :return: dictionary with keys as columns types and values that are lists of strings with column names - dictionary
+    """
+    key_cols = [col for col in profile if "_id" in col.lower()] + key_cols
+    objects = [col for col, stats in profile.items() if stats["object"] and col not in exclude + key_cols]
+    date_cols = [col for col in objects if profile[col]["date_like"]]
+    cat_cols = [col for col in objects if col not in date_cols]
+    numeric_cols = [col for col, stats in profile.items() if not stats["object"] and col not in exclude + key_cols]
+    cat_cols += [col for col in numeric_cols if profile[col]["distinct"] <= ratio * profile[col]["rows"]]
+    numeric_cols = [col for col in numeric_cols if col not in cat_cols]
+    return {"key": key_cols, "categoric": cat_cols, "date": date_cols, "numeric": numeric_cols}
+
+
+def _columns_mapping(df, types, exclude=[], key_cols=[]):
+    """
+    builds the mapping of get_cols from the type of every column, in the same order get_cols returns them
+    :param df: the dataframe - Dataframe
+    :param types: dictionary of column name to categoric, date or numeric - dictionary
+    :param exclude: columns to ignore - list of strings
+    :param key_cols: key columns that are added to the _id columns - list of strings
+    :return: dictionary with keys as columns types and values that are lists of strings with column names - dictionary
+    """
+    objects = df.select_dtypes(include=["object", "bool", "category"]).columns.tolist()
+    others = [col for col in df.columns.tolist() if col not in objects]
+    return {"key": [col for col in df.columns.tolist() if "_id" in col.lower()] + key_cols,
+            "categoric": [col for col in objects + others if types.get(col) == "categoric"],
+            "date": [col for col in objects if types.get(col) == "date"],
+            "numeric": [col for col in others if types.get(col) == "numeric"]}
+
+
+def get_cols_cached(df, exclude=[], ratio=0.1, key_cols=[], cache_path="columns_type_cache.json", hash_sample=False,
+                    sample_size=10000, random_state=0):
+    """
+    get_cols with a cache keyed by a fingerprint of the column names and dtypes (and optionally a hash of a sample of
+    the values). when the fingerprint is the same the types are returned without inference, when it changed only the
+    new and changed columns are inferred again
+    :param df: the dataframe to check for columns - Dataframe
+    :param exclude: columns to ignore - list of strings
+    :param ratio: the ratio of unique values of get_cols - float
+    :param key_cols: key columns that are added to the _id columns - list of strings
+    :param cache_path: the path of the cache file - string
+    :param hash_sample: if the values of a sample of the rows are part of the fingerprint - boolean
+    :param sample_size: the number of rows the types are inferred from, see get_cols - int
+    :param random_state: the seed of the sample - int
+    :return: dictionary with keys as columns types and values that are lists of strings with column names - dictionary
+    """
+    params = {"exclude": sorted(exclude), "ratio": ratio, "key_cols": key_cols, "sample_size": sample_size,
+              "random_state": random_state, "hash_sample": hash_sample}
+    sample = None
+    if hash_sample:
+        sample = _sample_rows(df, sample_size, random_state)
+        sample = df if sample is None else sample
+    schema = {}
+    for col in df.columns:
+        schema[col] = [str(df[col].dtype)]
+        if sample is not None:
+            schema[col].append(str(pd.util.hash_pandas_object(sample[col], index=False).values.sum()))
+    fingerprint = hashlib.sha1(json.dumps([params, [[col, schema[col]] for col in df.columns]],
+                                          default=str).encode("utf-8")).hexdigest()
+    cache = json.loads(open(cache_path).read()) if os.path.exists(cache_path) else {}
+    if cache.get("fingerprint") == fingerprint:
+        logging.info("columns types loaded from the cache")
+        return cache["mapping"]
+    known = cache.get("columns", {}) if cache.get("params") == params else {}
+    keys = [col for col in df.columns.tolist() if "_id" in col.lower()] + key_cols
+    cols = [col for col in df.columns if col not in keys + exclude]
+    changed = [col for col in cols if col not in known or known[col]["schema"] != schema[col]]
+    types = {col: known[col]["type"] for col in cols if col not in changed}
+    if changed:
+        logging.info("inferring the types of {} new or changed columns of {}".format(len(changed), len(cols)))
+        inferred = get_cols(df[changed], [], ratio, [], sample_size, random_state)
+        for col_type in ["categoric", "date", "numeric"]:
+            types.update({col: col_type for col in inferred[col_type]})
+    mapping = _columns_mapping(df, types, exclude, key_cols)
+    cache = {"fingerprint": fingerprint, "params": params, "mapping": mapping,
+             "columns": {col: {"schema": schema[col], "type": types[col]} for col in cols}}
+    json.dump(cache, open(cache_path, "w"))
+    return mapping
+
+
+def split_by_key(keys, train_per=0.7, seed=0):
+    """
+    splits the rows to train and test by a hash of their key, so all the rows of a key are on the same side and the
+    split is the same in every run and for every problem
+    :param keys: the key of every row, e.g. the account_id column - Series or numpy array
+    :param train_per: the fraction of the keys that go to train - float
+    :param seed: changes the split - int
+    :return: train_rows, test_rows: the positions of the train and test rows - tuple of numpy arrays
+    """
+    keys = np.asarray(keys)
+    # the same ids are hashed the same whatever integer dtype they were compacted to
+    if keys.dtype.kind in "iub":
+        keys = keys.astype(np.int64)
+    hashes = pd.util.hash_array(keys)
+    # the hash of numbers doesn't depend on hash_key, so the seed is mixed into the hashes and they are hashed again
+    hashes = pd.util.hash_array(hashes ^ pd.util.hash_array(np.array([seed], dtype=np.int64))[0])
+    # the top 53 bits of the hash as a uniform number in [0, 1)
+    train = (hashes >> np.uint64(11)).astype(np.float64) / 2 ** 53 < train_per
+    return np.flatnonzero(train), np.flatnonzero(~train)
+
+
+def plan_dtypes(df, category_ratio=0.5, exclude=[]):
+    """
+    plans the smallest safe dtype of every column: integers get the smallest width that holds their range, floats
+    become float32 only when every value is exactly the same after the round trip (like counts and amounts in whole
+    units, 0.95 would be read back as 0.94999999) and strings with few unique values become categories
+    :param df: the dataframe to plan for - Dataframe
+    :param category_ratio: a string column is a category if the number of unique values divided by the size of the
+    column is at most the ratio - float
+    :param exclude: columns to keep as they are - list of strings
+    :return: dictionary of column name to its new dtype, only the columns that change - dictionary
+    """
+    plan = {}
+    for col in df.columns:
+        if col in exclude:
+            continue
+        dtype = df[col].dtype
+        if dtype.kind in "iu":
+            if df.shape[0] == 0:
+                continue
+            low, high = df[col].min(), df[col].max()
+            for new_type in [np.int8, np.int16, np.int32]:
+                if np.iinfo(new_type).min <= low and high <= np.iinfo(new_type).max:
+                    if np.dtype(new_type).itemsize < dtype.itemsize:
+                        plan[col] = np.dtype(new_type)
+                    break
+        elif dtype == np.float64:
+            values = df[col].values
+            # nan and inf are the same in float32
+            values = values[np.isfinite(values)]
+            if values.shape[0] > 0 and np.abs(values).max() >= np.finfo(np.float32).max:
+                continue
+            if np.array_equal(values.astype(np.float32).astype(np.float64), values):
+                plan[col] = np.dtype(np.float32)
+        elif dtype == object:
+            if df[col].nunique() <= category_ratio * df.shape[0]:
+                plan[col] = "category"
+    return plan
+
+
+def compact_dtypes(df, plan=None, **kwargs):
+    """
+    converts the dataframe to the dtypes of plan_dtypes and logs how much memory was saved
+    :param df: the dataframe to convert - Dataframe
+    :param plan: the plan to apply, default: the plan of plan_dtypes for df - dictionary
+    :param kwargs: parameters of plan_dtypes - dictionary
+    :return: df: the converted dataframe - Dataframe
+    """
+    if plan is None:
+        plan = plan_dtypes(df, **kwargs)
+    plan = {col: dtype for col, dtype in plan.items() if col in df.columns}
+    before = df.memory_usage(deep=True).sum()
+    df = df.astype(plan)
+    after = df.memory_usage(deep=True).sum()
+    logging.info("dtypes of {} columns compacted, memory {:.1f}MB -> {:.1f}MB".format(len(plan), before / 2 ** 20,
+                                                                                      after / 2 ** 20))
+    return df
+
+
 def string_2json(x):
 
     try:
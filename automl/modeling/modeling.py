@@ -3,6 +3,7 @@ sys.path.append("automl")
 from automl.dev_tools import *
 from automl.preprocessing.transformers import *
 from automl.preprocessing.pipelines import *
+from automl.preprocessing.storage import *
 from sklearn.model_selection import RandomizedSearchCV, KFold
 import time
 import pickle
@@ -152,16 +153,28 @@ def over_sample(X_train, y_train):
         return X_train, y_train
 
 
-def model_pipeline_run(index, model, params, X_train, y_train, X_test, y_test, model_name, pre_process_time, type):
+def _as_float32(X):
+    """
+    :param X: the features - Dataframe or numpy array
+    :return: X as a float32 C-contiguous matrix, without a copy when it already is one - numpy array
+    """
+    if isinstance(X, np.ndarray) and X.dtype == np.float32 and X.flags["C_CONTIGUOUS"]:
+        return X
+    return np.ascontiguousarray(np.asarray(X, dtype=np.float32))
+
+
+def model_pipeline_run(index, model, params, X_train, y_train, X_test, y_test, model_name, pre_process_time, type,
+                       columns=None):
     """
     running the model_pipeline_run using a pipeline and with a grid search
     :param index: index of the data from all the
     :param model: the classifier/regressor to use
     :param params: the hyperparameters to optimize
-    :param X_train: the train dataset
+    :param X_train: the train dataset, a float32 matrix (see float32_matrix) is used as is without a copy
     :param y_train: the train target
-    :param X_test: the test dataset
+    :param X_test: the test dataset, a float32 matrix is used as is without a copy
     :param y_test: the test target
+    :param columns: the names of the columns when X_train is a matrix
     :return: a row in the information about run table
     """
     n_jobs = -1
@@ -203,14 +216,14 @@ def model_pipeline_run(index, model, params, X_train, y_train, X_test, y_test, m
             grid = RandomizedSearchCV(estimator=pipeline, param_distributions=params, cv=KFold(3), refit=True,
                                       verbose=0, n_jobs=n_jobs, n_iter=n_iter, error_score=np.nan)
         model_time = time.time()
-        columns = X_train.columns
+        columns = X_train.columns if columns is None else columns
+        X_train = _as_float32(X_train)
+        X_test = _as_float32(X_test)
         if "dl-rnn" in model_name:
-            X_train = np.reshape(X_train.astype("float32").values, (X_train.shape[0], 1, X_train.shape[1]))
-            X_test = np.reshape(X_test.astype("float32").values, (X_test.shape[0], 1, X_test.shape[1]))
-        else:
-            X_train = X_train.astype("float32").values
-            X_test = X_test.astype("float32").values
-        grid = grid.fit(X_train.astype("float32"), y_train)
+            # a view of the same buffer
+            X_train = np.reshape(X_train, (X_train.shape[0], 1, X_train.shape[1]))
+            X_test = np.reshape(X_test, (X_test.shape[0], 1, X_test.shape[1]))
+        grid = grid.fit(X_train, y_train)
         row["time"] = (time.time() - model_time) / 60
         row["pre_process_time"] = pre_process_time
         return scoring(grid, X_train, X_test, y_train, y_test, columns, row=row, model_name=model_name, type=type)
@@ -425,7 +438,7 @@ def explain(model, data, model_name, target, key_cols=[], shap_function=False, s
 
     if model_name in ["rf", "xgboost"]:
         if data is None:
-            data = pd.read_csv("preprocess_results/X_test_{}.csv".format(target), nrows=2)
+            data = read_table("preprocess_results/X_test_{}".format(target)).head(2)
         if model is None:
             model = pickle.load(open("results/model_results_{}_{}.p".format(target, model_name), "rb"))
         if not shap_function:
@@ -0,0 +1,213 @@
+import numpy as np
+import pandas as pd
+
+
+class GroupedAggregator:
+    """
+    aggregates many columns over the same groups, the group index is computed only once and every aggregation returns
+    one value per group (the collapsed level) instead of broadcasting the result back to the rows
+    """
+    def __init__(self, df, keys):
+        """
+        constructor
+        :param df: the data to aggregate, must be sorted by the keys so that every group is contiguous - Dataframe
+        :param keys: the columns that define the groups - list of strings
+        """
+        n = df.shape[0]
+        change = np.ones(n, dtype=bool)
+        if n > 0:
+            change[1:] = False
+            for key in keys:
+                values = df[key].values
+                change[1:] |= values[1:] != values[:-1]
+        self.keys = keys
+        self.starts = np.flatnonzero(change)
+        self.ends = np.append(self.starts[1:], n).astype(np.int64)
+        self.sizes = self.ends - self.starts
+        self.group_ids = np.cumsum(change) - 1
+        self.n_groups = self.starts.shape[0]
+
+    def _reduce(self, ufunc, values):
+        """
+        applies a reducing ufunc over the rows of every group
+        :param ufunc: the numpy ufunc to reduce with (add, fmin, fmax) - ufunc
+        :param values: the values to reduce, one per row - numpy array
+        :return: one value per group - numpy array
+        """
+        if self.n_groups == 0:
+            return np.array([], dtype=values.dtype)
+        return ufunc.reduceat(values, self.starts)
+
+    @staticmethod
+    def _as_float(values):
+        """
+        :param values: the values of a column - numpy array / Series
+        :return: the values as floats together with the mask of the missing values - tuple
+        """
+        values = np.asarray(values, dtype=float)
+        return values, np.isnan(values)
+
+    def first(self, df):
+        """
+        :param df: the rows the aggregator was built from - Dataframe
+        :return: the first row of every group - Dataframe
+        """
+        return df.iloc[self.starts].reset_index(drop=True)
+
+    def last(self, df):
+        """
+        :param df: the rows the aggregator was built from - Dataframe
+        :return: the last row of every group - Dataframe
+        """
+        return df.iloc[self.ends - 1].reset_index(drop=True)
+
+    def count(self, values=None):
+        """
+        :param values: if given only the not missing values are counted - numpy array
+        :return: the number of rows in every group - numpy array
+        """
+        if values is None:
+            return self.sizes.copy()
+        return self._reduce(np.add, (~pd.isnull(values)).astype(np.int64))
+
+    def sum(self, values):
+        """
+        :param values: the values to sum, missing values are skipped - numpy array
+        :return: the sum of every group - numpy array
+        """
+        values, missing = self._as_float(values)
+        return self._reduce(np.add, np.where(missing, 0, values))
+
+    def mean(self, values):
+        """
+        :param values: the values to average, missing values are skipped - numpy array
+        :return: the mean of every group - numpy array
+        """
+        values, missing = self._as_float(values)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.sum(values) / self.count(values)
+
+    def std(self, values, ddof=1):
+        """
+        sample standard deviation computed in two passes (mean and then squared deviations) to stay accurate
+        :param values: the values, missing values are skipped - numpy array
+        :param ddof: delta degrees of freedom, default: 1 - int
+        :return: the standard deviation of every group, nan for groups with not enough values - numpy array
+        """
+        values, missing = self._as_float(values)
+        means = self.mean(values)
+        deviations = np.where(missing, 0, values - means[self.group_ids]) ** 2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            var = self._reduce(np.add, deviations) / (self.count(values) - ddof)
+        var[self.count(values) - ddof <= 0] = np.nan
+        return np.sqrt(var)
+
+    def min(self, values):
+        """
+        :param values: the values, missing values are skipped - numpy array
+        :return: the minimum of every group - numpy array
+        """
+        values, missing = self._as_float(values)
+        return self._reduce(np.fmin, values)
+
+    def max(self, values):
+        """
+        :param values: the values, missing values are skipped - numpy array
+        :return: the maximum of every group - numpy array
+        """
+        values, missing = self._as_float(values)
+        return self._reduce(np.fmax, values)
+
+    def last_value(self, values):
+        """
+        :param values: the values of a column - numpy array
+        :return: the value of the last row of every group - numpy array
+        """
+        return np.asarray(values)[self.ends - 1]
+
+    def _pivot_codes(self, categories, levels):
+        """
+        :param categories: the category of every row - Series / numpy array
+        :param levels: the categories that will become columns - list
+        :return: the position of every row in the flattened (group, level) table, and the rows that have a level -
+        tuple
+        """
+        codes = pd.Categorical(categories, categories=levels).codes.astype(np.int64)
+        known = codes >= 0
+        return self.group_ids[known] * len(levels) + codes[known], known
+
+    def pivot_count(self, categories, levels, mask=None):
+        """
+        counts the rows of every category in every group
+        :param categories: the category of every row - Series / numpy array
+        :param levels: the categories to count - list
+        :param mask: if given only the rows where the mask is true are counted - numpy array of booleans
+        :return: a (groups x levels) table of counts - numpy array
+        """
+        positions, known = self._pivot_codes(categories, levels)
+        weights = None if mask is None else np.asarray(mask)[known].astype(float)
+        counts = np.bincount(positions, weights=weights, minlength=self.n_groups * len(levels))
+        return counts.reshape(self.n_groups, len(levels)).astype(np.int64)
+
+    def pivot_sum(self, values, categories, levels):
+        """
+        sums the values of every category in every group, the same as summing np.where(category == level, values, 0)
+        :param values: the values to sum, missing values are skipped - numpy array
+        :param categories: the category of every row - Series / numpy array
+        :param levels: the categories to sum - list
+        :return: a (groups x levels) table of sums - numpy array
+        """
+        values, missing = self._as_float(values)
+        positions, known = self._pivot_codes(categories, levels)
+        weights = np.where(missing, 0, values)[known]
+        sums = np.bincount(positions, weights=weights, minlength=self.n_groups * len(levels))
+        return sums.reshape(self.n_groups, len(levels))
+
+    def cumsum(self, values):
+        """
+        cumulative sums over the rows of every group, restarted at the start of every group. the loop runs over the
+        position inside the groups and each step is vectorized over all the groups, so the sums of one group never
+        carry the magnitude of the groups before it
+        :param values: the values to sum, one row per row of the data - 2d numpy array
+        :return: the cumulative sums - 2d numpy array
+        """
+        values = np.asarray(values, dtype=float)
+        sums = values.copy()
+        if self.n_groups == 0:
+            return sums
+        for position in range(1, int(self.sizes.max())):
+            rows = self.starts[self.sizes > position] + position
+            sums[rows] += sums[rows - 1]
+        return sums
+
+    def rolling_mean(self, values, windows, min_periods=None):
+        """
+        moving averages over the rows of every group for several columns and window lengths at once, the same as
+        groupby().transform(lambda x: x.rolling(window, min_periods).mean()) for every column and window. all the
+        windows are taken from one grouped cumulative sum of the values and of their valid counts, infinite values are
+        treated as missing like pandas does
+        :param values: the values, one row per row of the data and one column per feature - 2d numpy array
+        :param windows: the window lengths - list of ints
+        :param min_periods: the minimal number of valid values in a window as a function of the window length,
+        default: window - 1 - function
+        :return: dictionary of window length to the moving averages - dictionary of 2d numpy arrays
+        """
+        values = np.asarray(values, dtype=float)
+        if values.ndim == 1:
+            values = values[:, None]
+        m = values.shape[1]
+        valid = np.isfinite(values)
+        sums = self.cumsum(np.hstack([np.where(valid, values, 0), valid]))
+        positions = np.arange(values.shape[0]) - self.starts[self.group_ids]
+        means = {}
+        for window in windows:
+            before = positions >= window
+            window_sums = sums.copy()
+            window_sums[before] -= sums[np.flatnonzero(before) - window]
+            counts = window_sums[:, m:]
+            minp = window - 1 if min_periods is None else min_periods(window)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                mean = window_sums[:, :m] / counts
+            mean[counts < max(minp, 1)] = np.nan
+            means[window] = mean
+        return means
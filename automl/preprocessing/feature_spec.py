@@ -0,0 +1,145 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+
+# the panel features are declared in features.json (next to params.json) and compiled here to a flat list of steps.
+# every step reads the intermediates it needs from a shared cache (the float values of a column, a whole pivot table
+# of all the levels) so they are computed once, and only the features are put in the final table
+
+
+def load_feature_spec(path=None):
+    """
+    :param path: the path of the features specification, default: automl/features.json - string
+    :return: the specification - dictionary
+    """
+    path = path or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "features.json")
+    return json.loads(open(path).read())
+
+
+def _levels(block, categories):
+    """
+    :param block: a "by" block of the specification - dictionary
+    :param categories: the categories of the fields as returned by transactions_categories - dictionary
+    :return: pairs of (group, level) in the order of the features - list of tuples
+    """
+    levels = list(categories[block["by"]])
+    if "groups" not in block:
+        return [(None, level) for level in levels]
+    listed = [level for group in block["groups"].values() if group != "*" for level in group]
+    pairs = []
+    for group, group_levels in block["groups"].items():
+        group_levels = [level for level in levels if level not in listed] if group_levels == "*" else group_levels
+        pairs += [(group, level) for level in group_levels]
+    return pairs
+
+
+def compile_month_features(spec, categories):
+    """
+    expands the month features of the specification for the categories of the data to a list of steps
+    :param spec: the specification as returned by load_feature_spec - dictionary
+    :param categories: the categories of the fields as returned by transactions_categories - dictionary
+    :return: steps: one dictionary per feature, in the order of the columns - list of dictionaries
+    """
+    steps = []
+    for entry in spec["month_features"]:
+        if "by" not in entry:
+            steps.append(dict(entry))
+            continue
+        pairs = _levels(entry, categories)
+        # the pivot of a field is computed once for all of its levels
+        levels = [level for group, level in pairs]
+        for group, level in pairs:
+            name = level.replace(" ", "_") if entry.get("underscores") else level
+            for feature in entry["features"]:
+                step = dict(feature, by=entry["by"], levels=levels, level=level)
+                step["name"] = feature["name"].format(level=name, group=group)
+                if "divide_by" in feature:
+                    step["divide_by"] = feature["divide_by"].format(level=name, group=group)
+                steps.append(step)
+    return steps
+
+
+def _finish(step, values, features):
+    """
+    applies the division, rounding and imputation of a step
+    :param step: the step - dictionary
+    :param values: the values of the feature - numpy array
+    :param features: the features computed so far - dictionary
+    :return: the values - numpy array
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if "divide_by" in step:
+            values = values / features[step["divide_by"]]
+        if "round" in step:
+            values = np.round(values, step["round"])
+    if "fillna" in step:
+        values = np.where(np.isnan(values), step["fillna"], values)
+    return values
+
+
+def run_month_features(steps, trans_df, groups):
+    """
+    executes the compiled steps over the acc-month groups of the transactions
+    :param steps: the steps returned by compile_month_features - list of dictionaries
+    :param trans_df: the transactions, sorted by the groups - Dataframe
+    :param groups: the acc-month groups of the transactions - GroupedAggregator
+    :return: features: the features by name, in the order of the steps - dictionary of numpy arrays
+    """
+    floats, pivots, features = {}, {}, {}
+
+    def column(name):
+        if name not in floats:
+            floats[name] = groups._as_float(trans_df[name].values)
+        return floats[name]
+
+    def pivot(agg, by, levels, name=None):
+        key = (agg, by, tuple(levels), name)
+        if key not in pivots:
+            if agg == "count":
+                pivots[key] = groups.pivot_count(trans_df[by], levels)
+            elif agg == "sum":
+                pivots[key] = groups.pivot_sum(column(name)[0], trans_df[by], levels)
+            elif agg == "missing":
+                pivots[key] = groups.pivot_count(trans_df[by], levels, column(name)[1])
+        return pivots[key]
+
+    for step in steps:
+        agg = step.get("agg")
+        if "ratio" in step:
+            numerators, denominator = step["ratio"]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                values = sum(features[name] for name in numerators) / features[denominator]
+        elif "by" in step:
+            i = step["levels"].index(step["level"])
+            if agg == "mean":
+                # the avg is over all the rows of the group, where the other levels count as 0
+                sizes = groups.sizes - pivot("missing", step["by"], step["levels"], step["column"])[:, i]
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    values = pivot("sum", step["by"], step["levels"], step["column"])[:, i] / sizes
+            else:
+                values = pivot(agg, step["by"], step["levels"], step.get("column"))[:, i]
+        elif agg == "count":
+            values = groups.count(trans_df[step["column"]].values)
+        elif agg == "last":
+            values = groups.last_value(trans_df[step["column"]].values)
+        else:
+            values = getattr(groups, agg)(column(step["column"])[0])
+        features[step["name"]] = _finish(step, values, features)
+    return features
+
+
+def apply_time_gates(df, gates, end_month):
+    """
+    keeps the values of columns that are known only from a date and puts the default value before it, to avoid leakage
+    :param df: the panel - Dataframe
+    :param gates: the time_gates of the specification - list of dictionaries
+    :param end_month: the end of the month of every row - Series of datetime64
+    :return: df: the panel with the gated columns - Dataframe
+    """
+    for gate in gates:
+        known = np.datetime64(gate["from"]) <= end_month
+        for col in gate["columns"]:
+            df[col] = np.where(known, df[col], gate["else"])
+    return df
@@ -1,4 +1,9 @@
 from sklearn.pipeline import Pipeline
+import inspect
+import joblib
+import logging
+import os
+import pandas as pd
 
 
 class MLPipeline(Pipeline):
@@ -10,3 +15,210 @@ class MLPipeline(Pipeline):
 
         super(MLPipeline, self).__init__(steps)
         self.name = name
+
+
+def _source_hash(step):
+    """
+    :param step: a stage of a pipeline - Transformer
+    :return: the hash of the source of the module of the stage, None when the source is not available - string
+    """
+    try:
+        return joblib.hash(inspect.getsource(inspect.getmodule(type(step))))
+    except (OSError, TypeError):
+        return None
+
+
+class CachedPipeline(Pipeline):
+    """
+    pipeline of transformers that caches every fitted stage on disk, and the output of the last stage. the key of a
+    stage is a hash of the key of the stage before it (the first one of the input data) with the class, parameters,
+    fit parameters and the source of the module of the stage, so a stage is found in the cache only if its input, its
+    code and all the stages before it are the same. fit transforms the data through the longest cached prefix of
+    stages without fitting them again and fits the rest, when all the stages and the output are cached the output is
+    loaded. the least recently used entries are removed when the cache is larger than max_bytes.
+    with own_data the input is copied once and the stages change the data in place instead of copying it
+    """
+    def __init__(self, steps, cache_dir="pipeline_cache", max_bytes=2 * 1024 ** 3, own_data=True):
+        """
+        constructor
+        :param steps: the stages of the pipeline, all of them transformers - list of tuples
+        :param cache_dir: the folder of the cache - string
+        :param max_bytes: the maximal size of the cache folder - int
+        :param own_data: if the pipeline copies its input once and the stages don't copy it again - boolean
+        """
+        super(CachedPipeline, self).__init__(steps)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.own_data = own_data
+
+    def _set_owned(self, owned):
+        """
+        :param owned: if the stages can change their input in place, see CustomTransformer._own - boolean
+        """
+        for name, step in self.steps:
+            if hasattr(step, "_own"):
+                step.copy_input = not owned
+
+    def _path(self, key, kind):
+        return os.path.join(self.cache_dir, "{}.{}.p".format(key, kind))
+
+    def _fit_params(self, fit_params):
+        """
+        :param fit_params: free parameters, like in Pipeline.fit the name of the stage and the parameter are
+        separated by "__" - dictionary
+        :return: the parameters of every stage by its name - dictionary
+        """
+        params = {name: {} for name, step in self.steps}
+        for param, value in fit_params.items():
+            if "__" not in param:
+                raise ValueError("CachedPipeline.fit doesn't accept the fit parameter {}, you can pass parameters to "
+                                 "the stages with stage__parameter".format(param))
+            name, param = param.split("__", 1)
+            if name not in params:
+                raise ValueError("CachedPipeline has no stage {}".format(name))
+            params[name][param] = value
+        return params
+
+    def _keys(self, X, y, params):
+        """
+        :param X: features - Dataframe
+        :param y: target vector - Series
+        :param params: the fit parameters of every stage by its name - dictionary
+        :return: the key of every stage - list of strings
+        """
+        keys = []
+        key = joblib.hash((X, y))
+        for name, step in self.steps:
+            key = joblib.hash((key, name, type(step).__name__, step.get_params(), params[name], _source_hash(step)))
+            keys.append(key)
+        return keys
+
+    def _load(self, path):
+        # the modification time is the last use of the entry for the eviction
+        os.utime(path)
+        return joblib.load(path)
+
+    def _evict(self):
+        """
+        removes the least recently used entries until the cache is smaller than max_bytes
+        """
+        files = [os.path.join(self.cache_dir, file) for file in os.listdir(self.cache_dir)]
+        files = sorted(files, key=os.path.getmtime)
+        size = sum(os.path.getsize(file) for file in files)
+        while files and size > self.max_bytes:
+            file = files.pop(0)
+            size -= os.path.getsize(file)
+            os.remove(file)
+
+    def _dump(self, value, path):
+        joblib.dump(value, path)
+        self._evict()
+
+    def fit_transform(self, X, y=None, **fit_params):
+        """
+        fits the stages that are not in the cache and transforms X through all of them
+        :param X: features - Dataframe
+        :param y: target vector - Series
+        :param fit_params: free parameters of the stages, stage__parameter like in Pipeline.fit - dictionary
+        :return: Xt: the output of the last stage - Dataframe
+        """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        params = self._fit_params(fit_params)
+        keys = self._keys(X, y, params)
+        # the longest prefix of stages in the cache
+        cached = 0
+        while cached < len(keys) and os.path.exists(self._path(keys[cached], "stage")):
+            cached += 1
+        self.steps = [(name, self._load(self._path(key, "stage"))) if i < cached else (name, step)
+                      for i, ((name, step), key) in enumerate(zip(self.steps, keys))]
+        output = self._path(keys[-1], "output")
+        if cached == len(keys) and os.path.exists(output):
+            logging.info("CachedPipeline loads the output of all the {} stages".format(len(keys)))
+            return self._load(output)
+        if cached > 0:
+            logging.info("CachedPipeline skips the fit of the first {} of {} stages".format(cached, len(keys)))
+        Xt = X.copy(True) if self.own_data else X
+        # the stages are saved and returned with copy_input on so they never change data they don't own
+        self._set_owned(self.own_data)
+        try:
+            for i, (name, step) in enumerate(self.steps):
+                last = i == len(self.steps) - 1
+                if i < cached:
+                    # the same transform as in the fit_transform of the stage
+                    Xt = step.transform(Xt) if last else step.transform(Xt, y)
+                    continue
+                if not last:
+                    Xt = step.fit_transform(Xt, y, **params[name])
+                else:
+                    # like Pipeline.fit the last stage is only fitted with y and its output is transformed without
+                    # it, so a stage that adds y in transform (TimeSeriesTransformer) doesn't add the target
+                    Xt = step.fit(Xt, y, **params[name]).transform(Xt)
+                self._set_owned(False)
+                self._dump(step, self._path(keys[i], "stage"))
+                self._set_owned(self.own_data)
+        finally:
+            self._set_owned(False)
+        self._dump(Xt, output)
+        return Xt
+
+    def transform(self, X):
+        """
+        :param X: features - Dataframe
+        :return: Xt: the output of the last stage - Dataframe
+        """
+        if not self.own_data:
+            return super(CachedPipeline, self).transform(X)
+        self._set_owned(True)
+        try:
+            return super(CachedPipeline, self).transform(X.copy(True))
+        finally:
+            self._set_owned(False)
+
+    def fit(self, X, y=None, **fit_params):
+        """
+        :param X: features - Dataframe
+        :param y: target vector - Series
+        :param fit_params: free parameters - dictionary
+        :return: self: the fitted pipeline - CachedPipeline
+        """
+        self.fit_transform(X, y, **fit_params)
+        return self
+
+
+def pipeline_report(pipeline):
+    """
+    collects the stage_report of every stage of a fitted pipeline (see CustomTransformer)
+    :param pipeline: the fitted pipeline - Pipeline
+    :return: one row per fit or transform call with the name of the step, in the order of the steps - Dataframe
+    """
+    rows = [dict(record, step=name) for name, step in pipeline.steps for record in getattr(step, "stage_report", [])]
+    columns = ["step", "stage", "method", "wall_seconds", "cpu_seconds", "peak_rss_delta", "input_shape",
+               "input_bytes", "output_shape", "output_bytes"]
+    return pd.DataFrame(rows, columns=columns)
+
+
+def _transform_each(step, chunks):
+    for chunk in chunks:
+        yield step.transform(chunk)
+
+
+def stream_transform(pipeline, chunks):
+    """
+    transforms the data through a fitted pipeline in chunks, so the data and its transformation are never all in
+    memory. the chunks must be ordered by key and date, the stages that depend on the other rows of a key (the time
+    series imputer and TimeSeriesTransformer) carry the rows at the edge of the chunks (see transform_stream). the
+    other stages transform every row by what they learned in the fit. the stream is not always the same as
+    pipeline.transform of all the data: pipeline.transform clips the outliers to the extremes of the data it
+    transforms and drops the first category of the data in the dummies, the stream clips to the extremes of the data
+    of the fit and keeps the dummies of the fit
+    :param pipeline: the fitted pipeline, like the preprocess pipeline saved by features_pipeline - Pipeline
+    :param chunks: the features - iterator of Dataframes
+    :return: the transformed chunks - generator of Dataframes
+    """
+    for name, step in pipeline.steps:
+        if hasattr(step, "transform_stream"):
+            chunks = step.transform_stream(chunks)
+        else:
+            chunks = _transform_each(step, chunks)
+    return chunks
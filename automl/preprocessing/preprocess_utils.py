@@ -1,9 +1,13 @@
 from datetime import datetime
-import pandasql as ps
 from datetime import timedelta
 import time
 from automl.preprocessing.transformers import *
 from automl.preprocessing.pipelines import *
+from automl.preprocessing.aggregations import *
+from automl.preprocessing.storage import *
+from automl.preprocessing.feature_spec import *
+from concurrent.futures import ThreadPoolExecutor
+import pickle
 import logging
 from automl.dev_tools import *
 
@@ -14,18 +18,34 @@ logging.basicConfig(format='%(asctime)s     %(levelname)-8s %(message)s',
                     level='INFO')
 
 
-def get_data():
-
-    raw_data_files = os.listdir(os.getcwd()+"/raw_data")
-    raw_data_files_clean = [file.split(".")[0] for file in raw_data_files]
-    data = {}
-    for name in raw_data_files_clean:
-        data[name] = pd.read_csv(os.getcwd()+"/raw_data/"+name+".csv",sep=";")
-    # strip spaces from all columns names (left and right)
-
-    for key in list(data.keys()):
-        clean_col_names = [name.strip() for name in data[key].columns]
-        data[key].columns = clean_col_names
+def get_data(cache=True, n_jobs=None, exclude=[]):
+    """
+    loads all the raw data tables from the raw_data folder
+    :param exclude: names of tables not to load - list of strings
+    :param cache: to read the csv files through the columnar cache in raw_data_cache, only a changed csv is parsed
+    again - boolean
+    :param n_jobs: the number of tables to load in parallel, default: one thread per table up to the number of cpus -
+    int
+    :return: data: dictionary of table name to table - dictionary
+    """
+    raw_data_files = [file for file in os.listdir(os.getcwd()+"/raw_data") if file.endswith(".csv")]
+    raw_data_files_clean = [file.split(".")[0] for file in raw_data_files if file.split(".")[0] not in exclude]
+    cache_dir = os.getcwd()+"/raw_data_cache"
+
+    def read(name):
+        path = os.getcwd()+"/raw_data/"+name+".csv"
+        if cache:
+            return cached_read_csv(path, cache_dir, sep=";")
+        df = pd.read_csv(path, sep=";")
+        # strip spaces from all columns names (left and right)
+        df.columns = [col.strip() for col in df.columns]
+        return df
+
+    if n_jobs is None:
+        n_jobs = min(len(raw_data_files_clean), mp.cpu_count())
+    with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as executor:
+        tables = list(executor.map(read, raw_data_files_clean))
+    data = dict(zip(raw_data_files_clean, tables))
 
     return data
 
@@ -39,6 +59,43 @@ def int_to_date(date):
     return date
 
 
+def ints_to_dates(dates, birth_number=False):
+    """
+    vectorized version of int_to_date, converts a whole column of raw YYMMDD values to datetime64 in one pass
+    :param dates: the raw dates, missing values are returned as NaT, dates that are already datetime64 are returned as
+    they are - Series / array of int, float, string or datetime64
+    :param birth_number: if the values are birth numbers, where the month of a woman is stored as month + 50 - boolean
+    :return: the converted dates - Series of datetime64, and when birth_number is True also a boolean array that
+    indicates which of the birth numbers belongs to a woman - tuple
+    """
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        # already converted, for example the loans table when the panel is joined again with the same data
+        if birth_number:
+            raise ValueError("the birth numbers are already dates, the gender of the clients can't be found")
+        return dates if isinstance(dates, pd.Series) else pd.Series(dates)
+    index = dates.index if isinstance(dates, pd.Series) else None
+    dates = pd.Series(np.asarray(dates), index=index)
+    if dates.dtype.kind not in "iuf":
+        # strings can have a time suffix such as "931107 00:00:00", only the first 6 digits are relevant
+        dates = pd.to_numeric(dates.astype(str).str[:6], errors="coerce")
+    values = dates.values.astype(float)
+    valid = ~np.isnan(values)
+    values = np.where(valid, values, 0).astype(np.int64)
+    year = 1900 + values // 10000
+    month = values // 100 % 100
+    day = values % 100
+    female = valid & (month > 12)
+    if birth_number:
+        month = np.where(female, month - 50, month)
+    months = ((year - 1970) * 12 + month - 1).astype("datetime64[M]")
+    converted = months.astype("datetime64[D]") + (day - 1).astype("timedelta64[D]")
+    converted = np.where(valid, converted, np.datetime64("NaT")).astype("datetime64[ns]")
+    converted = pd.Series(converted, index=index)
+    if birth_number:
+        return converted, female
+    return converted
+
+
 def create_dates_table(start_date,end_date):
     
     # let's create a date table:
@@ -56,125 +113,271 @@ def create_dates_table(start_date,end_date):
     return date_df
 
 
-def feature_engineering_transactions(df_trans, dates_df):
+def join_months(df, dates_df, date_col):
+    """
+    inner join of a table with the dates table on validity_date_start_month <= date <= validity_date_end_month, the
+    month of each row is found by a sorted search over the month boundaries
+    :param df: the table to join, rows that are not inside any month are dropped - Dataframe
+    :param dates_df: the dates table created by create_dates_table - Dataframe
+    :param date_col: the datetime64 column in df to bucket - string
+    :return: the joined table, with the columns of dates_df first - Dataframe
+    """
+    starts = dates_df["validity_date_start_month"].values
+    ends = dates_df["validity_date_end_month"].values
+    dates = df[date_col].values.astype("datetime64[ns]")
+    months = np.searchsorted(starts, dates, side="right") - 1
+    inside = (months >= 0) & ~np.isnat(dates)
+    inside[inside] = dates[inside] <= ends[months[inside]]
+    months = dates_df.iloc[months[inside]].reset_index(drop=True)
+    return pd.concat([months, df[inside].reset_index(drop=True)], axis=1)
 
-    df_trans["date"] = df_trans["date"].apply(lambda x: int_to_date(x))
-    sqlcode = '''
-    select *
-    from dates_df
-    inner join df_trans on dates_df.validity_date_start_month <= df_trans.date and dates_df.validity_date_end_month >= df_trans.date
-    '''
-    trans_df = ps.sqldf(sqlcode,locals())
+
+def prepare_transactions(df_trans, dates_df):
+    """
+    converts the raw transactions dates, joins every transaction to its month and sorts them by account, month and
+    transaction
+    :param df_trans: the raw transactions table - Dataframe
+    :param dates_df: the dates table created by create_dates_table - Dataframe
+    :return: trans_df: the transactions with their month - Dataframe
+    """
+    df_trans["date"] = ints_to_dates(df_trans["date"])
+    trans_df = join_months(df_trans, dates_df, "date")
     #print(trans_df.shape)
-    trans_df["validity_date_start_month"] = trans_df["validity_date_start_month"].str[:10]
-    trans_df["validity_date_end_month"] = trans_df["validity_date_end_month"].str[:10]
-    trans_df = trans_df.sort_values(by=["account_id","validity_date_start_month","monthtable_rownumber"])
-    trans_df["date"] = trans_df["date"].str[:10]
     trans_df = trans_df.rename(columns={"date":"transaction_date"})
-    trans_df = trans_df.sort_values(by=["account_id","monthtable_rownumber","trans_id"])
-    # number of monthly transactions per account
-    trans_df["count_month_alltrans_account"] = trans_df.groupby(['account_id','monthtable_rownumber'])["trans_id"].transform('count')
+    trans_df = trans_df.sort_values(by=["account_id","monthtable_rownumber","trans_id"]).reset_index(drop=True)
     # we can see we have a k-symbol col with no name (just blank string)
     trans_df.loc[trans_df["k_symbol"]==' ',"k_symbol"] = "other"
-    # type field features
-    type_cats = list(trans_df["type"].unique())
-    for cat in type_cats:
-        # count credit, total withdrawl, total cash withdrawl
-        trans_df["count_month_"+cat] = np.where(trans_df["type"]==cat,1,0)
-        trans_df["count_month_"+cat] = trans_df.groupby(['account_id','monthtable_rownumber'])["count_month_"+cat].transform('sum')
-        # sum amount credit, total withdrawl, total cash withdrawl
-        trans_df["sum_amount_month_"+cat] = np.where(trans_df["type"]==cat,trans_df["amount"],0)
-        trans_df["sum_amount_month_"+cat] = trans_df.groupby(['account_id','monthtable_rownumber'])["sum_amount_month_"+cat].transform('sum')
-        # avg amount credit, total withdrawl, total cash withdrawl
-        trans_df["avg_amount_month_"+cat] = np.where(trans_df["type"]==cat,trans_df["amount"],0)
-        trans_df["avg_amount_month_"+cat] = trans_df.groupby(['account_id','monthtable_rownumber'])["avg_amount_month_"+cat].transform('mean')
-        trans_df["avg_amount_month_"+cat] = trans_df["avg_amount_month_"+cat].round(0)
-    # ratio withdrawl/credit
-    trans_df["ratio_month_wtdrl_credit"] = trans_df["sum_amount_month_withdrawal"]/trans_df["sum_amount_month_credit"]
-    trans_df["ratio_month_wtdrl_credit"] = trans_df["ratio_month_wtdrl_credit"].round(2)
-    # balance
-    # avg month balance
-    trans_df["avg_month_balance"] = trans_df.groupby(['account_id','monthtable_rownumber'])["balance"].transform('mean')
-    # std inter-month balance
-    trans_df["std_month_balance"] = trans_df.groupby(['account_id','monthtable_rownumber'])["balance"].transform('std')
-    # if we have only one value it will return nan. will replace by 0
-    trans_df["std_month_balance"] = trans_df["std_month_balance"].fillna(0)
-    # min balance/ avg balance
-    trans_df["min_month_balance"] = trans_df.groupby(['account_id','monthtable_rownumber'])["balance"].transform('min')
-    trans_df["min_avg_ratio_month_balance"] = trans_df["min_month_balance"]/trans_df["avg_month_balance"]
-    trans_df["min_avg_ratio_month_balance"] = trans_df["min_avg_ratio_month_balance"].round(2)
-    # last balance of the month
-    trans_df = trans_df.sort_values(by=["account_id","monthtable_rownumber","trans_id"])
-    trans_df["max_acc_month_transid"] = trans_df.groupby(['account_id','monthtable_rownumber'])["trans_id"].transform('max')
-    trans_df["endmonth_acc_balance"] = np.where(trans_df["max_acc_month_transid"]==trans_df["trans_id"],trans_df["balance"],np.nan)
-    trans_df = trans_df.sort_values(by=["account_id","monthtable_rownumber","trans_id"])
-    # total month withdrawl/end month balance
-    trans_df["ratio_month_wtdrl_endbalance"] = trans_df["sum_amount_month_withdrawal"]/trans_df["endmonth_acc_balance"]
-    trans_df["ratio_month_wtdrl_endbalance"] = trans_df["ratio_month_wtdrl_endbalance"].round(2)
-    # credit+withdrawl/balance
-    trans_df["ratio_month_wtdrl_cred_endbalance"] = (trans_df["sum_amount_month_withdrawal"]+trans_df["avg_amount_month_credit"])/trans_df["endmonth_acc_balance"]
-    trans_df["ratio_month_wtdrl_cred_endbalance"] = trans_df["ratio_month_wtdrl_cred_endbalance"].round(2)
-    # operation (vs type)
-    operation_list = list(trans_df["operation"].value_counts().index)
-    #print(operation_list)
-    type_operation_dict = {'credit':['collection from another bank','credit in cash'], 'withdrawal':[cat for cat in operation_list if cat not in ['collection from another bank','credit in cash']]}
-    #print(type_operation_dict)
-    # features
-    for key in list(type_operation_dict.keys()):
-        for var in type_operation_dict[key]:
-            trans_df["sum_amount_month_optype_"+key+"_"+var.replace(" ","_")] = np.where(trans_df["operation"]==var,trans_df["amount"],0)
-            trans_df["sum_amount_month_optype_"+key+"_"+var.replace(" ","_")] = trans_df.groupby(['account_id','monthtable_rownumber'])["sum_amount_month_optype_"+key+"_"+var.replace(" ","_")].transform('sum')
-            # I will not work with amounts, only with proportions
-            trans_df["pct_sum_amount_month_optype_"+key+"_"+var.replace(" ","_")] = trans_df["sum_amount_month_optype_"+key+"_"+var.replace(" ","_")]/trans_df["sum_amount_month_"+key]
-            trans_df["pct_sum_amount_month_optype_"+key+"_"+var.replace(" ","_")] = trans_df["pct_sum_amount_month_optype_"+key+"_"+var.replace(" ","_")].round(2)
-            # if we dont have any at the relevant type we will recieve nan. I will impute at 0
-            trans_df["pct_sum_amount_month_optype_"+key+"_"+var.replace(" ","_")] = trans_df["pct_sum_amount_month_optype_"+key+"_"+var.replace(" ","_")].fillna(0)
-            del trans_df["sum_amount_month_optype_"+key+"_"+var.replace(" ","_")]
-    # k_symbol
-    k_symbol_list = list(trans_df["k_symbol"].value_counts().index)
-    #print(k_symbol_list)
-    type_k_symbol_dict = {'credit':['interest credited','old-age pension'], 'withdrawal':[cat for cat in k_symbol_list if cat not in ['interest credited','old-age pension']]}
-    #print(type_k_symbol_dict)
-    # features
-    for key in list(type_k_symbol_dict.keys()):
-        for var in type_k_symbol_dict[key]:
-            trans_df["sum_amount_month_ktype_"+key+"_"+var.replace(" ","_")] = np.where(trans_df["k_symbol"]==var,trans_df["amount"],0)
-            trans_df["sum_amount_month_ktype_"+key+"_"+var.replace(" ","_")] = trans_df.groupby(['account_id','monthtable_rownumber'])["sum_amount_month_ktype_"+key+"_"+var.replace(" ","_")].transform('sum')
-            # I will not work with amounts, only with proportions
-            trans_df["pct_sum_amount_month_ktype_"+key+"_"+var.replace(" ","_")] = trans_df["sum_amount_month_ktype_"+key+"_"+var.replace(" ","_")]/trans_df["sum_amount_month_"+key]
-            trans_df["pct_sum_amount_month_ktype_"+key+"_"+var.replace(" ","_")] = trans_df["pct_sum_amount_month_ktype_"+key+"_"+var.replace(" ","_")].round(2)
-            # if we dont have any at the relevant type we will recieve nan. I will impute at 0
-            trans_df["pct_sum_amount_month_ktype_"+key+"_"+var.replace(" ","_")] = trans_df["pct_sum_amount_month_ktype_"+key+"_"+var.replace(" ","_")].fillna(0)
-            del trans_df["sum_amount_month_ktype_"+key+"_"+var.replace(" ","_")]
+    return trans_df
+
+
+def transactions_categories(trans_df):
+    """
+    finds the categories that the transactions features are created for, the type categories in order of appearance
+    and the operation and k_symbol categories from the most common one
+    :param trans_df: the transactions returned by prepare_transactions - Dataframe
+    :return: categories: dictionary with the keys type, operation and k_symbol - dictionary
+    """
+    return {"type": list(trans_df["type"].unique()),
+            "operation": list(trans_df["operation"].value_counts().index),
+            "k_symbol": list(trans_df["k_symbol"].value_counts().index)}
+
+
+def feature_engineering_transactions(df_trans, dates_df, ma_periods=(3, 6), categories=None):
+    """
+    creates the monthly transactions features, one obs per account-month
+    :param df_trans: the raw transactions table - Dataframe
+    :param dates_df: the dates table created by create_dates_table - Dataframe
+    :param ma_periods: the window lengths in months of the moving averages, sorted from short to long - list of ints
+    :param categories: the categories to create features for as returned by transactions_categories, default: the
+    categories found in df_trans - dictionary
+    :return: trans_df: the account-month features - Dataframe
+    """
+
+    trans_df = prepare_transactions(df_trans, dates_df)
+    if categories is None:
+        categories = transactions_categories(trans_df)
+    month_df = aggregate_transactions_months(trans_df, categories)
+    return moving_average_features(month_df, ma_periods)
+
+
+def aggregate_transactions_months(trans_df, categories, spec=None):
+    """
+    collapses the transactions to one obs per account-month with the monthly features of the features specification
+    :param trans_df: the transactions returned by prepare_transactions - Dataframe
+    :param categories: the categories to create features for as returned by transactions_categories - dictionary
+    :param spec: the features specification, default: features.json - dictionary
+    :return: month_df: the account-month features, without the moving averages - Dataframe
+    """
+    spec = spec or load_feature_spec()
+    # the acc-month groups are found once and every feature is aggregated straight to one obs per acc-month
+    groups = GroupedAggregator(trans_df, ["account_id","monthtable_rownumber"])
     # collapse transactions to one obs per acc-month
     # for example just take last value of the month (doesnt matter anyway)
-    trans_df = trans_df[trans_df["max_acc_month_transid"]==trans_df["trans_id"]]
-    # delete vars that are irrelevant in the collapsed level
-    vars_to_remove = ["transaction_date","type","operation","amount","balance","k_symbol","bank","account","trans_id","max_acc_month_transid"]
-    for var in vars_to_remove:
-        del trans_df[var]
+    # vars that are irrelevant in the collapsed level are not kept
+    vars_to_remove = ["transaction_date","type","operation","amount","balance","k_symbol","bank","account","trans_id"]
+    month_df = groups.last(trans_df[[col for col in trans_df.columns if col not in vars_to_remove]])
+    features = run_month_features(compile_month_features(spec, categories), trans_df, groups)
+    return pd.concat([month_df, pd.DataFrame(features, index=month_df.index)], axis=1)
 
-    trans_df = trans_df.sort_values(by=["account_id","monthtable_rownumber"])
+
+def moving_average_features(month_df, ma_periods=(3, 6), history=None, spec=None):
+    """
+    adds the moving averages of the monthly transactions features and their ratios
+    :param month_df: the account-month features, sorted by account and month - Dataframe
+    :param ma_periods: the window lengths in months of the moving averages, sorted from short to long - list of ints
+    :param history: earlier account-month rows of the same accounts that are only used to fill the windows of the
+    first rows of month_df, they are not returned - Dataframe
+    :param spec: the features specification with the moving_averages columns, default: features.json - dictionary
+    :return: trans_df: month_df with the moving averages features - Dataframe
+    """
+    trans_df = month_df
     # 2,3,4,6 month window avgs ma
     # because this is not a production level problem
-    cols_for_ma_list = ["count_month_alltrans_account","count_month_credit","count_month_withdrawal","count_month_withdrawal in cash", "sum_amount_month_credit","sum_amount_month_withdrawal","sum_amount_month_withdrawal in cash", "ratio_month_wtdrl_credit", "std_month_balance","min_avg_ratio_month_balance","endmonth_acc_balance", "ratio_month_wtdrl_endbalance","ratio_month_wtdrl_cred_endbalance", "pct_sum_amount_month_optype_credit_collection_from_another_bank", "pct_sum_amount_month_optype_credit_credit_in_cash", "pct_sum_amount_month_optype_withdrawal_withdrawal_in_cash", "pct_sum_amount_month_optype_withdrawal_remittance_to_another_bank", "pct_sum_amount_month_optype_withdrawal_credit_card_withdrawal", "pct_sum_amount_month_ktype_credit_interest_credited", "pct_sum_amount_month_ktype_credit_old-age_pension", "pct_sum_amount_month_ktype_withdrawal_payment_for_statement", "pct_sum_amount_month_ktype_withdrawal_household","pct_sum_amount_month_ktype_withdrawal_other", "pct_sum_amount_month_ktype_withdrawal_insurrance_payment", "pct_sum_amount_month_ktype_withdrawal_sanction_interest_if_negative_balance"]
-    for col in cols_for_ma_list:
-        for period in [3,6]:
-            trans_df['ma_month_'+str(period)+"_"+col] = trans_df.groupby(['account_id'])[col].transform(lambda x: x.rolling(period, period-1).mean())
-    # ma ratios
-    for col in cols_for_ma_list:
-        trans_df["1m_3m_"+col] = trans_df[col]/trans_df["ma_month_3_"+col]-1
-        trans_df["1m_3m_"+col] = trans_df["1m_3m_"+col].round(2)
-        trans_df["1m_3m_"+col] = trans_df["1m_3m_"+col].fillna(0)
-        # when we have 0/0 we get nan. I will impute it as 0
-        trans_df["3m_6m_"+col] = trans_df["ma_month_3_"+col]/trans_df["ma_month_6_"+col]-1
-        trans_df["3m_6m_"+col] = trans_df["3m_6m_"+col].round(2)
-        # when we have 0/0 we get nan. I will impute it as 0
-        trans_df["3m_6m_"+col] = trans_df["3m_6m_"+col].fillna(0)
+    cols_for_ma_list = (spec or load_feature_spec())["moving_averages"]
+    # a category that didn't appear in the transactions has 0 in all of its features
+    values = trans_df.reindex(columns=cols_for_ma_list, fill_value=0)
+    keys = trans_df[["account_id","monthtable_rownumber"]]
+    if history is not None:
+        values = pd.concat([history.reindex(columns=cols_for_ma_list, fill_value=0), values], ignore_index=True)
+        keys = pd.concat([history[["account_id","monthtable_rownumber"]], keys], ignore_index=True)
+    # all the columns and window lengths are computed from one grouped cumulative sum over the sorted acc-months
+    order = np.lexsort((keys["monthtable_rownumber"].values, keys["account_id"].values))
+    accounts = GroupedAggregator(keys.iloc[order], ["account_id"])
+    ma = accounts.rolling_mean(values.values[order], ma_periods, lambda period: period-1)
+    # back to the rows of month_df
+    rows = np.empty(len(order), dtype=np.int64)
+    rows[order] = np.arange(len(order))
+    rows = rows[len(order) - trans_df.shape[0]:]
+    ma = {period: ma[period][rows] for period in ma_periods}
+    features = {}
+    for i, col in enumerate(cols_for_ma_list):
+        for period in ma_periods:
+            features['ma_month_'+str(period)+"_"+col] = ma[period][:, i]
+    # ma ratios, the month over the shortest window and then every window over the next one (1m_3m_, 3m_6m_, ...)
+    for i, col in enumerate(cols_for_ma_list):
+        short, short_name = values[col].values[len(values) - trans_df.shape[0]:], "1m"
+        for period in ma_periods:
+            name = short_name+"_"+str(period)+"m_"+col
+            with np.errstate(divide="ignore", invalid="ignore"):
+                features[name] = pd.Series(short/ma[period][:, i]-1).round(2)
+            # when we have 0/0 we get nan. I will impute it as 0
+            features[name] = features[name].fillna(0).values
+            short, short_name = ma[period][:, i], str(period)+"m"
+    trans_df = pd.concat([trans_df, pd.DataFrame(features, index=trans_df.index)], axis=1)
     #print(trans_df.shape)
     return trans_df
 
 
+def feature_engineering_transactions_streaming(path, dates_df, output_dir, ma_periods=(3, 6), chunk_size=1000000,
+                                               sep=";"):
+    """
+    streaming version of feature_engineering_transactions for transactions tables that don't fit in memory. the csv is
+    read in chunks of chunk_size rows twice: first to find the categories and the number of transactions of every
+    account, then to split the transactions into account ranges of about chunk_size transactions. every range holds
+    all the transactions of its accounts, so it is processed with feature_engineering_transactions and appended as a
+    part to output_dir. the peak memory is bounded by chunk_size and the parts together are the same as the in memory
+    result
+    :param path: the path of the raw transactions csv - string
+    :param dates_df: the dates table created by create_dates_table - Dataframe
+    :param output_dir: the folder to write the account-month features parts to - string
+    :param ma_periods: the window lengths in months of the moving averages - list of ints
+    :param chunk_size: the number of transactions to hold in memory at once - int
+    :param sep: the csv separator - string
+    :return: output_dir: the folder with the parts, in account order, read them with read_tables - string
+    """
+    spill_dir = os.path.join(output_dir, "spill")
+    if not os.path.exists(spill_dir):
+        os.makedirs(spill_dir)
+    # remove the parts of a previous run
+    for folder in [output_dir, spill_dir]:
+        for file in os.listdir(folder):
+            if file.startswith("part-"):
+                os.remove(os.path.join(folder, file))
+    # first pass, the categories have to be global so that every part has the same features
+    first_rows, operations, k_symbols, accounts = [], [], [], []
+    for chunk in pd.read_csv(path, sep=sep, chunksize=chunk_size):
+        chunk.columns = [col.strip() for col in chunk.columns]
+        accounts.append(chunk["account_id"].value_counts())
+        trans_df = prepare_transactions(chunk, dates_df)
+        first_rows.append(trans_df.drop_duplicates("type")[["account_id","monthtable_rownumber","trans_id","type"]])
+        operations.append(trans_df["operation"].value_counts())
+        k_symbols.append(trans_df["k_symbol"].value_counts())
+    first_rows = pd.concat(first_rows).sort_values(by=["account_id","monthtable_rownumber","trans_id"])
+    categories = {"type": list(first_rows["type"].drop_duplicates()),
+                  "operation": list(pd.concat(operations).groupby(level=0).sum().sort_values(ascending=False).index),
+                  "k_symbol": list(pd.concat(k_symbols).groupby(level=0).sum().sort_values(ascending=False).index)}
+    logging.info("Transactions categories found: " + str(categories))
+    # account ranges of about chunk_size transactions, an account is never split between two ranges
+    accounts = pd.concat(accounts).groupby(level=0).sum().sort_index()
+    ranges = (accounts.cumsum().values - 1) // chunk_size
+    bounds = accounts.index.values[np.flatnonzero(np.r_[True, ranges[1:] != ranges[:-1]])]
+    logging.info("Transactions split to {} account ranges".format(len(bounds)))
+    # second pass, spill every chunk to the files of its ranges
+    for chunk in pd.read_csv(path, sep=sep, chunksize=chunk_size):
+        chunk.columns = [col.strip() for col in chunk.columns]
+        parts = np.searchsorted(bounds, chunk["account_id"].values, side="right") - 1
+        for part, rows in chunk.groupby(parts):
+            with open(os.path.join(spill_dir, "part-%05d.p" % part), "ab") as f:
+                pickle.dump(rows, f)
+    # every range is processed on its own
+    for part in range(len(bounds)):
+        file = os.path.join(spill_dir, "part-%05d.p" % part)
+        if not os.path.exists(file):
+            continue
+        pieces = []
+        with open(file, "rb") as f:
+            while True:
+                try:
+                    pieces.append(pickle.load(f))
+                except EOFError:
+                    break
+        os.remove(file)
+        trans_df = feature_engineering_transactions(pd.concat(pieces, ignore_index=True), dates_df, ma_periods,
+                                                    categories)
+        write_table(trans_df, os.path.join(output_dir, "part-%05d" % part))
+        logging.info("Transactions part {} of {} complete with shape of {}".format(part + 1, len(bounds), trans_df.shape))
+    os.rmdir(spill_dir)
+    return output_dir
+
+
+def refresh_panel(df_joined, df_trans_new, data, dates_df, cutoff_date, ma_periods=(3, 6)):
+    """
+    incremental version of the panel creation, only the account-months from cutoff_date on are computed again. the
+    moving averages of the first new months are filled from the trailing rows of the stored panel, so the refreshed
+    panel is the same as a full rebuild while the cost grows only with the new transactions. the rows of the stored
+    panel before cutoff_date are kept as they are, except for the ages of the clients, that are imputed with the mean
+    over all the rows of the refreshed panel like in a full build. data is not changed
+    :param df_joined: the stored panel as returned by join_data_final - Dataframe
+    :param df_trans_new: all the raw transactions dated on or after cutoff_date, earlier ones are ignored - Dataframe
+    :param data: the other raw data tables as returned by get_data - dictionary of Dataframes
+    :param dates_df: the dates table created by create_dates_table, must include the new months - Dataframe
+    :param cutoff_date: the first day of the first month to compute again, for example "1997-12-01" - string
+    :param ma_periods: the window lengths in months of the moving averages - list of ints
+    :return: df_joined: the refreshed panel - Dataframe
+    """
+    cutoff = pd.Timestamp(cutoff_date)
+    if cutoff != cutoff.replace(day=1):
+        raise ValueError("cutoff_date must be the first day of a month, got " + str(cutoff_date))
+    # clean_and_join_other_data and join_data_final change the tables they get
+    data = {name: table.copy() for name, table in data.items()}
+    trans_df = prepare_transactions(df_trans_new, dates_df)
+    trans_df = trans_df[trans_df["validity_date_start_month"] >= cutoff].reset_index(drop=True)
+    stored = df_joined[df_joined["validity_date_start_month"].astype('datetime64[ns]') < cutoff]
+    stored = stored.sort_values(by=["account_id","monthtable_rownumber"], kind="mergesort")
+    # the types of the stored panel get their features even when they didn't appear in the new months
+    categories = transactions_categories(trans_df)
+    categories["type"] += [col[len("count_month_"):] for col in df_joined.columns if col.startswith("count_month_")
+                           and "sum_amount_month_" + col[len("count_month_"):] in df_joined.columns
+                           and col[len("count_month_"):] not in categories["type"]]
+    month_df = aggregate_transactions_months(trans_df, categories)
+    # the windows of the first new months need the last rows of the same accounts before the cutoff
+    history = stored[stored["account_id"].isin(month_df["account_id"].unique())]
+    history = history.groupby("account_id").tail(max(ma_periods) - 1)
+    trans_df = moving_average_features(month_df, ma_periods, history)
+    logging.info("Trans table refreshed from " + str(cutoff.date()) + " with shape of " + str(trans_df.shape))
+    new_columns = [col for col in trans_df.columns if col not in df_joined.columns]
+    if new_columns:
+        logging.info("New transactions categories are not in the stored panel and are skipped: " + str(new_columns))
+    df = clean_and_join_other_data(data)
+    # the mean age over all the rows of the refreshed panel, the stored rows and the new ones
+    month_cols = ["account_id","monthtable_rownumber","validity_date_end_month"]
+    months = pd.concat([stored.drop_duplicates(["account_id","monthtable_rownumber"])[month_cols], trans_df[month_cols]],
+                       ignore_index=True)
+    ages = pd.merge(months, df[["account_id","birth_number"]], on="account_id", how="left")
+    ages["client_age"] = client_age(ages["validity_date_end_month"], ages["birth_number"])
+    age_fill_value = ages["client_age"].mean()
+    # the ages of the stored rows were imputed with the mean of the stored panel
+    ages["client_age"] = ages["client_age"].fillna(age_fill_value).round(0)
+    age_range = ages.groupby(["account_id","monthtable_rownumber"])["client_age"].agg(["max","min"])
+    stored_keys = pd.MultiIndex.from_frame(stored[["account_id","monthtable_rownumber"]])
+    stored = stored.assign(max_age_acc=age_range["max"].reindex(stored_keys).values,
+                           min_age_acc=age_range["min"].reindex(stored_keys).values)
+    df_new = join_data_final(df, trans_df, data, age_fill_value)
+    df_joined = pd.concat([stored, df_new.reindex(columns=df_joined.columns, fill_value=0)], ignore_index=True)
+    df_joined = df_joined.sort_values(by=["account_id","monthtable_rownumber"], kind="mergesort")
+    return df_joined.reset_index(drop=True)
+
+
 def clean_and_join_other_data(data):
     
     # join client and disp
@@ -217,14 +420,10 @@ def clean_and_join_other_data(data):
     # Extracts all genders from birthdate pattern (for women month = month_numer + 50; for men month = month_number)
     # Get the 3rd and 4th character from "birth_number". If it is > 12
     # that row is for Female, otherwise Male
-    df["gender"] = np.where(df["birth_number"].astype(str).str[2:4].astype(int)>12,"female","male")
-    # Now correct the "birth_number". Subtract 50 form middle 2 digits.
-    # Updated based on feedback from @RuiBarradas to use df$Gender == "Female" 
-    # to subtract 50 from month number
-    df["birth_number"] = np.where(df["gender"]=="female",df["birth_number"]-5000,df["birth_number"])
-    # convert to regular date
-    df["birth_number"] = df["birth_number"].apply(lambda x: int_to_date(x))
-    df["account_date"] = df["account_date"].apply(lambda x: int_to_date(x))
+    # the month correction (subtract 50 from the middle 2 digits of women) is done while converting to a regular date
+    df["birth_number"], female = ints_to_dates(df["birth_number"], birth_number=True)
+    df["gender"] = np.where(female,"female","male")
+    df["account_date"] = ints_to_dates(df["account_date"])
     # per account features
     # number of clients in account
     df["num_clients_account"] = df.groupby('account_id')["client_id"].transform('count')
@@ -240,7 +439,7 @@ def clean_and_join_other_data(data):
     df["pctchg_crime_9695"] = df["no. of commited crimes '96"]/df["no. of commited crimes '95"]-1
     df["pctchg_crime_9695"] = df["pctchg_crime_9695"].round(1)
     # cards
-    data["card_train"]["issued"] = data["card_train"]["issued"].apply(lambda x: int_to_date(x))
+    data["card_train"]["issued"] = ints_to_dates(data["card_train"]["issued"])
     data["card_train"] = data["card_train"].rename(columns={"type":"card_type","issued":"card_issued"})
     # join cards
     #print(df.shape)
@@ -249,7 +448,26 @@ def clean_and_join_other_data(data):
     return df
 
 
-def join_data_final(df,trans_df,data):
+def client_age(end_month, birth_number):
+    """
+    :param end_month: the end of the month of every row - Series
+    :param birth_number: the birth date of every row - Series of datetime64
+    :return: the age in whole years at the end of the month - Series
+    """
+    return ((end_month.astype('datetime64[ns]') - birth_number)/timedelta(days=365)).round(0)
+
+
+def join_data_final(df,trans_df,data,age_fill_value=None,spec=None):
+    """
+    joins the client level table to the account-month features and brings it to one obs per account-month
+    :param df: the table returned by clean_and_join_other_data - Dataframe
+    :param trans_df: the table returned by feature_engineering_transactions - Dataframe
+    :param data: the raw data tables, the loan_train table is used - dictionary of Dataframes
+    :param age_fill_value: the age to impute for clients without a birth date, default: the mean age of the rows -
+    float
+    :param spec: the features specification with the time_gates, default: features.json - dictionary
+    :return: df_joined: the panel - Dataframe
+    """
 
     # join meta data df to trans
     # because df is in client level, trans_df will be larger now
@@ -257,34 +475,30 @@ def join_data_final(df,trans_df,data):
     #print(df.shape)
     df_joined = pd.merge(trans_df,df,on="account_id",how="left")
     #print(df_joined.shape)
+    end_month = df_joined["validity_date_end_month"].astype('datetime64[ns]')
     # to bring it to account level I just need to handle ages of clients
-    df_joined["client_age"] = (df_joined["validity_date_end_month"].astype('datetime64[ns]') - df['birth_number'])/timedelta(days=365)
-    df_joined["client_age"] = df_joined["client_age"].round(0)
+    df_joined["client_age"] = client_age(end_month, df_joined['birth_number'])
     # impute mean
-    df_joined["client_age"] = df_joined["client_age"].fillna(df_joined["client_age"].mean()).round(0)
+    if age_fill_value is None:
+        age_fill_value = df_joined["client_age"].mean()
+    df_joined["client_age"] = df_joined["client_age"].fillna(age_fill_value).round(0)
     # min age acc, max age acc
     df_joined["max_age_acc"] = df_joined.groupby(['account_id','monthtable_rownumber'])["client_age"].transform('max')
     df_joined["min_age_acc"] = df_joined.groupby(['account_id','monthtable_rownumber'])["client_age"].transform('min')
     # and also the card vars which are in disp level
     # in case of datetime fields nan is NaT, cannot add regular nan np.datetime64('2088-01-01'), np.datetime64(NaT)
     # I will assume arbitrary date atm
-    df_joined["card_type"] = np.where( (df_joined["card_issued"]>df_joined["validity_date_end_month"].astype('datetime64[ns]')) | (df_joined["card_type"].isna()), "no_card",df_joined["card_type"])
-    df_joined["years_since_card_issued"] = np.where(df_joined["card_type"]=="no_card", -100.0, (df_joined["validity_date_end_month"].astype('datetime64[ns]') - df_joined['card_issued'])/timedelta(days=365))
+    df_joined["card_type"] = np.where( (df_joined["card_issued"]>end_month) | (df_joined["card_type"].isna()), "no_card",df_joined["card_type"])
+    df_joined["years_since_card_issued"] = np.where(df_joined["card_type"]=="no_card", -100.0, (end_month - df_joined['card_issued'])/timedelta(days=365))
     df_joined["years_since_card_issued"] = df_joined["years_since_card_issued"].round(2)
     # if one of the disps has a card and the other doesn't I will take the max of -100 and something positive
     df_joined["years_since_card_issued"] = df_joined.groupby(['account_id','monthtable_rownumber'])["years_since_card_issued"].transform('max')
     # no need for account date
-    df_joined["years_since_account_date"] = (df_joined["validity_date_end_month"].astype('datetime64[ns]') - df_joined['account_date'])/timedelta(days=365)
+    df_joined["years_since_account_date"] = (end_month - df_joined['account_date'])/timedelta(days=365)
     df_joined["years_since_account_date"] = df_joined["years_since_account_date"].round(2)
 
     # 95 96 vars make sure district features with years are only used in the panel in releveant dates and avoid leakage
-    df_joined["unemploymant rate '95"] = np.where(np.datetime64('1995-01-01')<=df_joined["validity_date_end_month"].astype('datetime64[ns]'), df_joined["unemploymant rate '95"], -100.0)
-    df_joined["unemploymant rate '96"] = np.where(np.datetime64('1996-01-01')<=df_joined["validity_date_end_month"].astype('datetime64[ns]'), df_joined["unemploymant rate '96"], -100.0)
-    df_joined["no. of commited crimes '95"] = np.where(np.datetime64('1995-01-01')<=df_joined["validity_date_end_month"].astype('datetime64[ns]'), df_joined["no. of commited crimes '95"], -100.0)
-    df_joined["no. of commited crimes '96"] = np.where(np.datetime64('1996-01-01')<=df_joined["validity_date_end_month"].astype('datetime64[ns]'), df_joined["no. of commited crimes '96"], -100.0)
-    df_joined["pctchg_unempl_9695"] = np.where(np.datetime64('1996-01-01')<=df_joined["validity_date_end_month"].astype('datetime64[ns]'), df_joined["pctchg_unempl_9695"], -100.0)
-    df_joined["pctchg_crime_9695"] = np.where(np.datetime64('1996-01-01')<=df_joined["validity_date_end_month"].astype('datetime64[ns]'), df_joined["pctchg_crime_9695"], -100.0)
-    accounts_with_cards = df_joined[df_joined["card_type"]!="no_card"].sort_values(by=["account_id","monthtable_rownumber","card_type"])["account_id"].tolist()
+    df_joined = apply_time_gates(df_joined, (spec or load_feature_spec())["time_gates"], end_month)
     # bring it to account level
     # gender will be owner gender
     df_joined = df_joined[df_joined["type"]=="OWNER"]
@@ -297,18 +511,20 @@ def join_data_final(df,trans_df,data):
     df_joined = df_joined.drop_duplicates()
     #print(df_joined.shape)
     # join the loan data
-    data["loan_train"]["date"] = data["loan_train"]["date"].apply(lambda x: int_to_date(x))
+    data["loan_train"]["date"] = ints_to_dates(data["loan_train"]["date"])
     data["loan_train"] = data["loan_train"].rename(columns={"date":"loan_date"})
     #print(df_joined.shape)
     #print(data["loan_train"].shape)
     df_joined = pd.merge(df_joined,data["loan_train"],on="account_id",how="left")
     #print(df_joined.shape)
+    # the rows changed with the loans join
+    end_month = df_joined["validity_date_end_month"].astype('datetime64[ns]')
     df_joined["target_loan"] = np.where(~(df_joined["loan_id"].isna()),1,0)
     df_joined["target_amount"] = np.where(~(df_joined["loan_id"].isna()),df_joined["amount"],0)
     # also make the target 0 if loan date didnt arrive yet
-    df_joined["target_loan"] = np.where( (df_joined["loan_date"]>df_joined["validity_date_end_month"].astype('datetime64[ns]'))
+    df_joined["target_loan"] = np.where( (df_joined["loan_date"]>end_month)
                                      | (df_joined["card_type"].isna()), 0,df_joined["target_loan"])
-    df_joined["target_amount"] = np.where( (df_joined["loan_date"]>df_joined["validity_date_end_month"].astype('datetime64[ns]'))
+    df_joined["target_amount"] = np.where( (df_joined["loan_date"]>end_month)
                                      | (df_joined["card_type"].isna()), 0,df_joined["target_amount"])
     del df_joined["loan_id"]
     del df_joined["amount"]
@@ -319,6 +535,75 @@ def join_data_final(df,trans_df,data):
     return df_joined
 
 
+def init_panel(trans_df, df, loans):
+    """
+    shares the panel inputs with the workers of the pool, with fork they are inherited instead of being pickled to
+    every task
+    :param trans_df: the transactions returned by prepare_transactions - Dataframe
+    :param df: the table returned by clean_and_join_other_data - Dataframe
+    :param loans: the raw loan_train table - Dataframe
+    :return: None
+    """
+    global panel_trans_df, panel_df, panel_loans
+    panel_trans_df = trans_df
+    panel_df = df
+    panel_loans = loans
+
+
+def panel_partition(args):
+    """
+    creates the panel rows of a range of accounts, the transactions of the range are the rows start to end of the
+    shared transactions
+    :param args: start, end, categories, ma_periods and age_fill_value - tuple
+    :return: df_joined: the panel of the accounts in the range - Dataframe
+    """
+    start, end, categories, ma_periods, age_fill_value = args
+    trans_df = panel_trans_df.iloc[start:end].reset_index(drop=True)
+    trans_df = moving_average_features(aggregate_transactions_months(trans_df, categories), ma_periods)
+    df = panel_df[panel_df["account_id"].isin(trans_df["account_id"].unique())]
+    return join_data_final(df, trans_df, {"loan_train": panel_loans.copy()}, age_fill_value)
+
+
+def create_panel_parallel(data, dates_df, ma_periods=(3, 6), n_jobs=None, partitions_per_job=4):
+    """
+    parallel version of the panel creation, every feature is local to an account so the accounts are split to ranges
+    of about the same number of transactions and every range is created in a worker of a process pool. the ranges are
+    in account order so the partitions are concatenated without sorting the panel again. the categories and the age
+    imputation are global and are found before the split, so the panel is the same as in a single process
+    :param data: the raw data tables as returned by get_data - dictionary of Dataframes
+    :param dates_df: the dates table created by create_dates_table - Dataframe
+    :param ma_periods: the window lengths in months of the moving averages - list of ints
+    :param n_jobs: the number of processes, default: the number of cpus - int
+    :param partitions_per_job: the number of account ranges per process, more ranges balance the load better - int
+    :return: df_joined: the panel - Dataframe
+    """
+    n_jobs = n_jobs or mp.cpu_count()
+    trans_df = prepare_transactions(data["trans_train"], dates_df)
+    categories = transactions_categories(trans_df)
+    df = clean_and_join_other_data(data)
+    # the mean age over all the rows of the panel
+    months = GroupedAggregator(trans_df, ["account_id","monthtable_rownumber"])
+    ages = pd.merge(months.first(trans_df[["account_id","validity_date_end_month"]]), df[["account_id","birth_number"]],
+                    on="account_id", how="left")
+    age_fill_value = client_age(ages["validity_date_end_month"], ages["birth_number"]).mean()
+    # account ranges of about the same number of transactions, an account is never split between two ranges
+    accounts = GroupedAggregator(trans_df, ["account_id"])
+    n_parts = max(min(n_jobs * partitions_per_job, accounts.n_groups), 1)
+    ranges = (np.cumsum(accounts.sizes) - 1) * n_parts // max(trans_df.shape[0], 1)
+    bounds = np.append(accounts.starts[np.flatnonzero(np.r_[True, ranges[1:] != ranges[:-1]])], trans_df.shape[0])
+    tasks = [(bounds[i], bounds[i + 1], categories, ma_periods, age_fill_value) for i in range(len(bounds) - 1)]
+    logging.info("Panel split to {} account ranges over {} processes".format(len(tasks), n_jobs))
+    if n_jobs == 1 or len(tasks) == 1:
+        init_panel(trans_df, df, data["loan_train"])
+        parts = [panel_partition(task) for task in tasks]
+    else:
+        pool = mp.Pool(n_jobs, initializer=init_panel, initargs=(trans_df, df, data["loan_train"]))
+        parts = pool.map(panel_partition, tasks, chunksize=1)
+        pool.close()
+        pool.join()
+    return pd.concat(parts, ignore_index=True)
+
+
 def over_sample(X_train, y_train):
 
     list_index = []
@@ -340,8 +625,31 @@ def over_sample(X_train, y_train):
         return X_train, y_train
 
 
+def features_prefix(columns, key=None, date=None, cache_dir="preprocess_results/cache", cache_bytes=2 * 1024 ** 3):
+    """
+    the stages of the features pipeline that don't use the target, they are fitted once for all the problems
+    :param columns: the columns dictionary - dictionary where each key has list of features names - dictionary
+    :param key: the key column - string
+    :param date: the date column - string
+    :param cache_dir: the folder of the cache of the fitted stages, see CachedPipeline - string
+    :param cache_bytes: the maximal size of the cache - int
+    :return: the pipeline of the stages - CachedPipeline
+    """
+    clear_stage = ClearNoCategoriesTransformer(categorical_cols=columns["categoric"])
+    imputer = ImputeTransformer(numerical_cols=columns["numeric"], categorical_cols=columns["categoric"],
+                                strategy="time_series", key_field=key, date_field=date, parallel=True)
+    outliers = OutliersTransformer(numerical_cols=columns["numeric"], categorical_cols=columns["categoric"])
+    scale = ScalingTransformer(numerical_cols=columns["numeric"])
+    steps_feat = [("clear_non_variance", clear_stage),
+                  ("imputer", imputer),
+                  ("outliers", outliers),
+                  ("scaling", scale)]
+    return CachedPipeline(steps=steps_feat, cache_dir=cache_dir, max_bytes=cache_bytes)
+
+
 def features_pipeline(index, X_train, y_train ,X_test, y_test, columns, row, spark, key=None, date=None, static_cols=[],
-                      r=1, w=2, corr_per=0.5, oversample=True):
+                      r=1, w=2, corr_per=0.5, oversample=True, cache_dir="preprocess_results/cache",
+                      cache_bytes=2 * 1024 ** 3, prefix=None, prefix_time=0, spark_store=False):
     """
     running a problemread_data
     :param index: the index of the sampled from the original dataset - int
@@ -349,18 +657,23 @@ def features_pipeline(index, X_train, y_train ,X_test, y_test, columns, row, spa
     :param X_test: the test dataset - Dataframe
     :param y_test: the test target - Dataframe
     :param columns: the columns dictionary - dictionary where each key has list of features names - dictionary
+    :param cache_dir: the folder of the cache of the fitted stages, see CachedPipeline - string
+    :param cache_bytes: the maximal size of the cache - int
+    :param prefix: the fitted features_prefix shared by the problems, X_train and X_test are already transformed by it,
+    default: the prefix is fitted here - CachedPipeline
+    :param prefix_time: the seconds it took to fit and apply the shared prefix - float
+    :param spark_store: if the results are also saved as tables of the spark catalog - boolean
     :return: a list of one tuple with results and information about the model_pipeline_run run
     """
-    start_time = time.time()
+    start_time = time.time() - prefix_time
     # X_train = df.drop(columns["target"][0], axis=1)
     # y_train = df[columns["target"][0]]
     file_name = "preprocess_results/preprocess_pipeline_{}".format(row["target"])
-    # pre proccess pipeline stages
-    clear_stage = ClearNoCategoriesTransformer(categorical_cols=columns["categoric"])
-    imputer = ImputeTransformer(numerical_cols=columns["numeric"], categorical_cols=columns["categoric"],
-                                strategy="time_series", key_field=key, date_field=date, parallel=True)
-    outliers = OutliersTransformer(numerical_cols=columns["numeric"], categorical_cols=columns["categoric"])
-    scale = ScalingTransformer(numerical_cols=columns["numeric"])
+    # pre proccess pipeline stages, the target independent ones are the prefix
+    if prefix is None:
+        prefix = features_prefix(columns, key, date, cache_dir, cache_bytes)
+        X_train = prefix.fit_transform(X_train)
+        X_test = prefix.transform(X_test)
     if row["type"] == "classification":
         categorize = CategorizeByTargetTransformer(categorical_cols=columns["categoric"])
     else:
@@ -375,11 +688,7 @@ def features_pipeline(index, X_train, y_train ,X_test, y_test, columns, row, spa
     dummies = DummiesTransformer(columns["categoric"])
     timeseries = TimeSeriesTransformer(key=key, date=date, key_col=X_train.reset_index()[key], date_col=X_train.reset_index()[date],
                                        split_y=False, static_cols=static_cols, r=r, w=w, target=columns["target"][0])
-    steps_feat = [("clear_non_variance", clear_stage),
-                  ("imputer", imputer),
-                  ("outliers", outliers),
-                  ("scaling", scale),
-                  ("chisquare", chisquare),
+    steps_feat = [("chisquare", chisquare),
                   ("correlations", correlations),
                   ("categorize", categorize),
                   ("dummies", dummies),
@@ -387,41 +696,39 @@ def features_pipeline(index, X_train, y_train ,X_test, y_test, columns, row, spa
                   ("timeseries", timeseries)]
     if key is None:
         steps_feat = steps_feat[:-1]
-    pipeline_feat = Pipeline(steps=steps_feat)
-    pipeline_feat = pipeline_feat.fit(X_train, y_train)
-    X_train = pipeline_feat.transform(X_train)
+    # the stages that their input and parameters didn't change since the last run are loaded from the cache
+    pipeline_feat = CachedPipeline(steps=steps_feat, cache_dir=cache_dir, max_bytes=cache_bytes)
+    X_train = pipeline_feat.fit_transform(X_train, y_train)
     X_test = pipeline_feat.transform(X_test)
+    # the models are fitted on X_train and scored on X_test, they must have the same features
+    if list(X_train.columns) != list(X_test.columns):
+        raise ValueError("the train and test features are different: {}".format(
+            sorted(set(X_train.columns) ^ set(X_test.columns))))
+    # the saved pipeline transforms the raw features through the prefix and the problem stages
+    pipeline_feat = Pipeline(steps=prefix.steps + pipeline_feat.steps)
     finish_time = time.time()
     time_in_minutes = (finish_time - start_time) / 60
     if not os.path.exists("preprocess_results/"):
         os.mkdir("preprocess_results/")
     save(open(file_name, "wb"), (row["target"], index, time_in_minutes, pipeline_feat))
+    # the time and memory of every fit and transform of the stages
+    pipeline_report(pipeline_feat).to_csv("preprocess_results/stages_report_{}.csv".format(row["target"]), index=False)
     if oversample and row["type"] == "classification":
         X_train, y_train = over_sample(X_train, y_train)
-    #todo change this so it will save the data as a table inside the spark session
-    # spark_df_joined = spark.createDataFrame(X_train)
-    # spark_df_joined.createOrReplaceTempView("preprocess_results.X_train_{}".format(row["target"]))
-    # spark_df_joined = spark.createDataFrame(y_train)
-    # spark_df_joined.createOrReplaceTempView("preprocess_results.y_train_{}.csv".format(row["target"]))
-    # spark_df_joined = spark.createDataFrame(X_train)
-    # spark_df_joined.createOrReplaceTempView("preprocess_results.X_test_{}.csv".format(row["target"]))
-    # spark_df_joined = spark.createDataFrame(X_train)
-    # spark_df_joined.createOrReplaceTempView("preprocess_results.y_test_{}.csv".format(row["target"]))
-    X_train.reset_index().to_csv("preprocess_results/X_train_{}.csv".format(row["target"]), index=False)
-    y_train.to_csv("preprocess_results/y_train_{}.csv".format(row["target"]), index=False)
-    X_test.reset_index().to_csv("preprocess_results/X_test_{}.csv".format(row["target"]), index=False)
-    y_test.to_csv("preprocess_results/y_test_{}.csv".format(row["target"]), index=False)
+    if spark_store:
+        from automl.preprocessing.spark_utils import spark_write_preprocess_results
+        spark_write_preprocess_results(spark, row["target"], X_train, y_train, X_test, y_test)
+    write_preprocess_results(row["target"], X_train, y_train, X_test, y_test)
     x = (row["target"], index, X_train, y_train.values, X_test, y_test.values, time_in_minutes, pipeline_feat)
     return x
 
 
-def read_data(target, keys, spark):
+def read_data(target, keys, spark, batch_size=10000):
 
+    # the spark tables are collected through arrow
+    from automl.preprocessing.spark_utils import spark_read_preprocess_results
     file_name = "preprocess_results/preprocess_pipeline_{}.p".format(target)
     target, index, time_in_minutes, pipeline_feat = load(open(file_name, "rb"))
-    X_train = spark.sql("select * from preprocess_results.X_train_{}".format(target)).toPandas().set_index(keys)
-    y_train = spark.sql("select * from preprocess_results.y_train_{}".format(target)).toPandas().values.flatten()
-    X_test = spark.sql("select * from preprocess_results.X_test_{}".format(target)).toPandas().set_index(keys)
-    y_test = spark.sql("select * from preprocess_results.y_test_{}".format(target)).toPandas().values.flatten()
+    X_train, y_train, X_test, y_test = spark_read_preprocess_results(spark, target, keys, batch_size=batch_size)
 
     return target, index, X_train, y_train, X_test, y_test, time_in_minutes, pipeline_feat
@@ -0,0 +1,276 @@
+import logging
+import os
+from pyspark.sql import functions as F
+from pyspark.sql import Window
+from automl.preprocessing.preprocess_utils import create_dates_table
+from automl.preprocessing.spark_utils import to_spark
+from automl.preprocessing.feature_spec import load_feature_spec
+
+
+# the spark version of the panel creation, every step is the same as in preprocess_utils but runs on the executors so
+# the panel is never materialized on the driver
+
+
+def _col(name):
+    """
+    :param name: column name, can contain dots and quotes like "no. of commited crimes '95" - string
+    :return: the column - spark Column
+    """
+    return F.col("`" + name + "`")
+
+
+def _divide(a, b):
+    """
+    division that behaves like numpy: x/0 is inf or -inf and 0/0 is missing (spark returns null for both)
+    :param a: numerator - spark Column
+    :param b: denominator - spark Column
+    :return: the ratio - spark Column
+    """
+    return (F.when(b == 0, F.when(a > 0, F.lit(float("inf"))).when(a < 0, F.lit(float("-inf"))))
+            .otherwise(a / b))
+
+
+def _fillna(column, value=0):
+    """
+    :param column: the column - spark Column
+    :param value: the value to put instead of null and nan - number
+    :return: the filled column - spark Column
+    """
+    return F.coalesce(F.nanvl(column, F.lit(value)), F.lit(value))
+
+
+def spark_ints_to_dates(column, birth_number=False):
+    """
+    spark version of ints_to_dates, converts raw YYMMDD values to timestamps
+    :param column: the name of the column with the raw dates - string
+    :param birth_number: if the values are birth numbers, where the month of a woman is stored as month + 50 - boolean
+    :return: the dates, and when birth_number is True also a column that indicates a woman - spark Column / tuple
+    """
+    values = F.substring(_col(column).cast("string"), 1, 6).cast("long")
+    year = F.floor(values / 10000) + 1900
+    month = F.floor(values / 100) % 100
+    day = values % 100
+    female = F.coalesce(month > 12, F.lit(False))
+    if birth_number:
+        month = F.when(female, month - 50).otherwise(month)
+    dates = F.to_timestamp(F.concat_ws("-", year.cast("string"), F.lpad(month.cast("string"), 2, "0"),
+                                       F.lpad(day.cast("string"), 2, "0")), "yyyy-MM-dd")
+    if birth_number:
+        return dates, female
+    return dates
+
+
+def spark_get_data(session, folder):
+    """
+    loads all the raw data tables from a folder of csv files to spark
+    :param session: the spark session - SparkSession
+    :param folder: the folder of the raw data, for example os.getcwd()+"/raw_data" - string
+    :return: data: dictionary of table name to the table - dictionary of spark Dataframes
+    """
+    data = {}
+    for file in [file for file in os.listdir(folder) if file.endswith(".csv")]:
+        df = session.read.option("header", "true").option("sep", ";").option("inferSchema", "true")\
+            .csv(os.path.join(folder, file))
+        data[file.split(".")[0]] = df.toDF(*[col.strip() for col in df.columns])
+    return data
+
+
+def spark_dates_table(session, start_date, end_date):
+    """
+    :param session: the spark session - SparkSession
+    :param start_date: expected format is: "1993-01-01" - string
+    :param end_date: expected format is: "1997-12-31" - string
+    :return: the dates table created by create_dates_table in spark - spark Dataframe
+    """
+    return to_spark(session, create_dates_table(start_date, end_date), mapping={})
+
+
+def spark_prepare_transactions(df_trans, dates_df):
+    """
+    spark version of prepare_transactions, joins every transaction to its month with a broadcast range join
+    :param df_trans: the raw transactions table - spark Dataframe
+    :param dates_df: the dates table - spark Dataframe
+    :return: trans_df: the transactions with their month - spark Dataframe
+    """
+    trans_df = df_trans.withColumn("transaction_date", spark_ints_to_dates("date")).drop("date")
+    dates_df = F.broadcast(dates_df)
+    trans_df = dates_df.join(trans_df, (dates_df["validity_date_start_month"] <= trans_df["transaction_date"]) &
+                             (trans_df["transaction_date"] <= dates_df["validity_date_end_month"]), "inner")
+    # we can see we have a k-symbol col with no name (just blank string)
+    return trans_df.withColumn("k_symbol", F.when(F.col("k_symbol") == " ", "other").otherwise(F.col("k_symbol")))
+
+
+def spark_transactions_categories(trans_df):
+    """
+    spark version of transactions_categories, only the categories themselves are collected to the driver
+    :param trans_df: the transactions returned by spark_prepare_transactions - spark Dataframe
+    :return: categories: dictionary with the keys type, operation and k_symbol - dictionary
+    """
+    first = trans_df.where(F.col("type").isNotNull()).groupBy("type")\
+        .agg(F.min(F.struct("account_id", "monthtable_rownumber", "trans_id")).alias("first")).orderBy("first")
+    categories = {"type": [row["type"] for row in first.collect()]}
+    for field in ["operation", "k_symbol"]:
+        counts = trans_df.where(F.col(field).isNotNull()).groupBy(field).count().orderBy(F.desc("count"), field)
+        categories[field] = [row[field] for row in counts.collect()]
+    return categories
+
+
+def spark_feature_engineering_transactions(df_trans, dates_df, ma_periods=(3, 6), categories=None):
+    """
+    spark version of feature_engineering_transactions, the month features are one group aggregation and the moving
+    averages are window functions over the months of every account
+    :param df_trans: the raw transactions table - spark Dataframe
+    :param dates_df: the dates table - spark Dataframe
+    :param ma_periods: the window lengths in months of the moving averages, sorted from short to long - list of ints
+    :param categories: the categories to create features for as returned by transactions_categories, default: the
+    categories found in df_trans - dictionary
+    :return: trans_df: the account-month features - spark Dataframe
+    """
+    trans_df = spark_prepare_transactions(df_trans, dates_df)
+    if categories is None:
+        categories = spark_transactions_categories(trans_df)
+    logging.info("Transactions categories found: " + str(categories))
+    amount = F.coalesce(F.col("amount").cast("double"), F.lit(0.0))
+    type_operation_dict = {'credit': ['collection from another bank', 'credit in cash'],
+                           'withdrawal': [cat for cat in categories["operation"]
+                                          if cat not in ['collection from another bank', 'credit in cash']]}
+    type_k_symbol_dict = {'credit': ['interest credited', 'old-age pension'],
+                          'withdrawal': [cat for cat in categories["k_symbol"]
+                                         if cat not in ['interest credited', 'old-age pension']]}
+    # every sum of the month in one aggregation, the features are computed from them after
+    aggs = [F.count("trans_id").alias("count_month_alltrans_account"), F.count(F.lit(1)).alias("_size"),
+            F.avg("balance").alias("avg_month_balance"), F.stddev_samp("balance").alias("std_month_balance"),
+            F.min("balance").alias("min_month_balance"),
+            F.max(F.struct("trans_id", "balance"))["balance"].alias("endmonth_acc_balance")]
+    for cat in categories["type"]:
+        aggs += [F.sum(F.when(F.col("type") == cat, 1).otherwise(0)).alias("count_month_" + cat),
+                 F.sum(F.when(F.col("type") == cat, amount).otherwise(0.0)).alias("sum_amount_month_" + cat),
+                 F.sum(F.when((F.col("type") == cat) & F.col("amount").isNull(), 1).otherwise(0)).alias("_missing_" + cat)]
+    for field, prefix, type_dict in [("operation", "optype", type_operation_dict), ("k_symbol", "ktype", type_k_symbol_dict)]:
+        for key in type_dict.keys():
+            for var in type_dict[key]:
+                aggs.append(F.sum(F.when(F.col(field) == var, amount).otherwise(0.0)).alias("_sum_" + prefix + "_" + key + "_" + var))
+    month_df = trans_df.groupBy("validity_date_start_month", "validity_date_end_month", "monthtable_rownumber",
+                                "account_id").agg(*aggs)
+    features = [_col(col) for col in ["validity_date_start_month", "validity_date_end_month", "monthtable_rownumber",
+                                      "account_id", "count_month_alltrans_account"]]
+    for cat in categories["type"]:
+        features += [_col("count_month_" + cat), _col("sum_amount_month_" + cat),
+                     F.bround(_col("sum_amount_month_" + cat) / (F.col("_size") - _col("_missing_" + cat)), 0)
+                     .alias("avg_amount_month_" + cat)]
+    month_df = month_df.select(*(features + [_col(col) for col in month_df.columns if col.startswith("_")] +
+                                 ["avg_month_balance", "std_month_balance", "min_month_balance", "endmonth_acc_balance"]))
+    month_df = month_df\
+        .withColumn("ratio_month_wtdrl_credit", F.bround(_divide(F.col("sum_amount_month_withdrawal"), F.col("sum_amount_month_credit")), 2))\
+        .withColumn("std_month_balance", _fillna(F.col("std_month_balance")))\
+        .withColumn("min_avg_ratio_month_balance", F.bround(_divide(F.col("min_month_balance"), F.col("avg_month_balance")), 2))\
+        .withColumn("ratio_month_wtdrl_endbalance", F.bround(_divide(F.col("sum_amount_month_withdrawal"), F.col("endmonth_acc_balance")), 2))\
+        .withColumn("ratio_month_wtdrl_cred_endbalance", F.bround(_divide(F.col("sum_amount_month_withdrawal") + F.col("avg_amount_month_credit"), F.col("endmonth_acc_balance")), 2))
+    for field, prefix, type_dict in [("operation", "optype", type_operation_dict), ("k_symbol", "ktype", type_k_symbol_dict)]:
+        for key in type_dict.keys():
+            for var in type_dict[key]:
+                # I will not work with amounts, only with proportions, and if we dont have any at the relevant type we
+                # will recieve nan. I will impute at 0
+                name = "pct_sum_amount_month_" + prefix + "_" + key + "_" + var.replace(" ", "_")
+                month_df = month_df.withColumn(name, _fillna(F.bround(_divide(_col("_sum_" + prefix + "_" + key + "_" + var), _col("sum_amount_month_" + key)), 2)))
+    month_df = month_df.drop(*[col for col in month_df.columns if col.startswith("_")])
+    cols_for_ma_list = load_feature_spec()["moving_averages"]
+    # a category that didn't appear in the transactions has 0 in all of its features
+    for col in cols_for_ma_list:
+        if col not in month_df.columns:
+            month_df = month_df.withColumn(col, F.lit(0.0))
+    # moving averages over the rows of every account with min_periods of window-1, infinite values are missing like
+    # in pandas rolling
+    ma, ratios = [], []
+    for col in cols_for_ma_list:
+        value = _col(col).cast("double")
+        valid = F.when(F.isnan(value) | (F.abs(value) == float("inf")), None).otherwise(value)
+        short, short_name = value, "1m"
+        for period in ma_periods:
+            window = Window.partitionBy("account_id").orderBy("monthtable_rownumber").rowsBetween(-(period - 1), 0)
+            mean = F.when(F.count(valid).over(window) >= max(period - 1, 1), F.avg(valid).over(window))
+            ma.append(mean.alias('ma_month_' + str(period) + "_" + col))
+            # when we have 0/0 we get nan. I will impute it as 0
+            ratios.append(_fillna(F.bround(_divide(short, mean) - 1, 2)).alias(short_name + "_" + str(period) + "m_" + col))
+            short, short_name = mean, str(period) + "m"
+    return month_df.select(*([_col(col) for col in month_df.columns] + ma + ratios))
+
+
+def spark_clean_and_join_other_data(data):
+    """
+    spark version of clean_and_join_other_data, the client level table
+    :param data: the raw data tables as returned by spark_get_data - dictionary of spark Dataframes
+    :return: df: the client level table - spark Dataframe
+    """
+    # join client and disp, then the account meta (the district of the client is kept)
+    df = data["client"].join(data["disp"], "client_id", "inner")
+    df = df.join(data["account"].drop("district_id"), "account_id", "inner").withColumnRenamed("date", "account_date")
+    # clean question marks in two numeric cols, impute them with mean
+    district = data["district"]
+    for col, digits in [("unemploymant rate '95", 2), ("no. of commited crimes '95", 0)]:
+        known = F.when(_col(col).cast("string") != "?", _col(col).cast("double"))
+        mean = district.agg(F.round(F.avg(known), digits)).collect()[0][0]
+        district = district.withColumn(col, F.coalesce(known, F.lit(mean)))
+    df = df.join(district, df["district_id"] == district["code"], "inner").withColumnRenamed("name", "district_name")
+    # for women month = month_numer + 50, the month is corrected while converting to a regular date
+    birth_number, female = spark_ints_to_dates("birth_number", birth_number=True)
+    df = df.withColumn("gender", F.when(female, "female").otherwise("male")).withColumn("birth_number", birth_number)
+    df = df.withColumn("account_date", spark_ints_to_dates("account_date"))
+    # per account features
+    account = Window.partitionBy("account_id")
+    df = df.withColumn("num_clients_account", F.count("client_id").over(account))\
+        .withColumn("num_districts_account", F.size(F.collect_set("district_id").over(account)))\
+        .withColumn("num_genders_account", F.size(F.collect_set("gender").over(account)))
+    # pct change unemployment and crimes 95-96 (can only be used in 96)
+    df = df.withColumn("pctchg_unempl_9695", F.bround(_divide(_col("unemploymant rate '96"), _col("unemploymant rate '95")) - 1, 1))\
+        .withColumn("pctchg_crime_9695", F.bround(_divide(_col("no. of commited crimes '96"), _col("no. of commited crimes '95")) - 1, 1))
+    # join cards
+    cards = data["card_train"].select("disp_id", F.col("type").alias("card_type"),
+                                      spark_ints_to_dates("issued").alias("card_issued"))
+    return df.join(cards, "disp_id", "left")
+
+
+def spark_join_data_final(df, trans_df, data):
+    """
+    spark version of join_data_final, brings the client level table to the account-month panel and adds the targets
+    :param df: the table returned by spark_clean_and_join_other_data - spark Dataframe
+    :param trans_df: the table returned by spark_feature_engineering_transactions - spark Dataframe
+    :param data: the raw data tables as returned by spark_get_data - dictionary of spark Dataframes
+    :return: df_joined: the panel - spark Dataframe
+    """
+    df_joined = trans_df.join(df, "account_id", "left")\
+        .select(*[_col(col) for col in trans_df.columns + [col for col in df.columns if col != "account_id"]])
+    end = F.col("validity_date_end_month").cast("timestamp")
+    acc_month = Window.partitionBy("account_id", "monthtable_rownumber")
+    # ages of clients, impute mean
+    df_joined = df_joined.withColumn("client_age", F.bround(F.datediff(end, F.col("birth_number")) / 365, 0))
+    mean_age = df_joined.agg(F.avg("client_age")).collect()[0][0]
+    df_joined = df_joined.withColumn("client_age", F.bround(F.coalesce(F.col("client_age"), F.lit(mean_age)), 0))\
+        .withColumn("max_age_acc", F.max("client_age").over(acc_month))\
+        .withColumn("min_age_acc", F.min("client_age").over(acc_month))
+    # card vars which are in disp level
+    df_joined = df_joined.withColumn("card_type", F.when((F.col("card_issued") > end) | F.col("card_type").isNull(), "no_card")
+                                     .otherwise(F.col("card_type")))
+    df_joined = df_joined.withColumn("years_since_card_issued", F.when(F.col("card_type") == "no_card", -100.0)
+                                     .otherwise(F.bround(F.datediff(end, F.col("card_issued")) / 365, 2)))
+    # if one of the disps has a card and the other doesn't I will take the max of -100 and something positive
+    df_joined = df_joined.withColumn("years_since_card_issued", F.max("years_since_card_issued").over(acc_month))
+    df_joined = df_joined.withColumn("years_since_account_date", F.bround(F.datediff(end, F.col("account_date")) / 365, 2))
+    # make sure district features with years are only used in the panel in releveant dates and avoid leakage
+    for gate in load_feature_spec()["time_gates"]:
+        for col in gate["columns"]:
+            df_joined = df_joined.withColumn(col, F.when(F.lit(gate["from"]).cast("timestamp") <= end, _col(col).cast("double"))
+                                             .otherwise(float(gate["else"])))
+    # bring it to account level, gender will be owner gender
+    df_joined = df_joined.where(F.col("type") == "OWNER")\
+        .drop("client_id", "disp_id", "type", "birth_number", "code", "card_issued", "client_age", "account_date")\
+        .dropDuplicates()
+    # join the loan data
+    loans = data["loan_train"].withColumn("date", spark_ints_to_dates("date")).withColumnRenamed("date", "loan_date")
+    df_joined = df_joined.join(loans, "account_id", "left")
+    # the target is 0 if loan date didnt arrive yet
+    not_yet = F.coalesce((F.col("loan_date") > end) | F.col("card_type").isNull(), F.lit(False))
+    df_joined = df_joined\
+        .withColumn("target_loan", F.when(not_yet | F.col("loan_id").isNull(), 0).otherwise(1))\
+        .withColumn("target_amount", F.when(not_yet | F.col("loan_id").isNull(), 0).otherwise(F.col("amount")))
+    return df_joined.drop("loan_id", "amount", "loan_date", "duration", "payments", "status")
@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import time
+import numpy as np
+import pandas as pd
+from pyspark.sql import functions as F
+from pyspark.sql import types as T
+
+
+# pandas <-> spark conversions through arrow record batches instead of row by row through py4j
+
+
+def arrow_available():
+    """
+    :return: if pyarrow can be imported on the driver - boolean
+    """
+    try:
+        import pyarrow
+        return True
+    except ImportError:
+        return False
+
+
+def configure_arrow(session, batch_size=10000):
+    """
+    turns on the arrow conversions of the session, spark falls back to the row by row conversion by itself when a
+    column type is not supported by arrow
+    :param session: the spark session - SparkSession
+    :param batch_size: the maximal number of rows in an arrow record batch - int
+    :return: if arrow is used - boolean
+    """
+    enabled = arrow_available()
+    session.conf.set("spark.sql.execution.arrow.pyspark.enabled", str(enabled).lower())
+    session.conf.set("spark.sql.execution.arrow.pyspark.fallback.enabled", "true")
+    session.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", str(batch_size))
+    if not enabled:
+        logging.info("pyarrow is not installed, the spark conversions are row by row")
+    return enabled
+
+
+def load_columns_mapping(path=None):
+    """
+    :param path: the path of columns_type_mapping.json, default: the one written by preprocess_data - string
+    :return: the mapping of column type to columns or None if it wasn't created yet - dictionary
+    """
+    path = path or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "columns_type_mapping.json")
+    if not os.path.exists(path):
+        return None
+    return json.loads(open(path).read())
+
+
+def spark_schema(df, mapping=None):
+    """
+    builds an explicit spark schema for a pandas table so spark doesn't infer the types from the rows. the columns of
+    columns_type_mapping.json get their type from it (date - timestamp, numeric - double) and the rest by their dtype
+    :param df: the table - Dataframe
+    :param mapping: the content of columns_type_mapping.json - dictionary
+    :return: the schema and the table with the columns converted to it - tuple
+    """
+    mapping = mapping or {}
+    dates = set(mapping.get("date", []))
+    numerics = set(mapping.get("numeric", []))
+    fields = []
+    converted = {}
+    for col in df.columns:
+        kind = df[col].dtype.kind
+        if col in dates or kind == "M":
+            if kind != "M":
+                converted[col] = pd.to_datetime(df[col], errors="coerce")
+            spark_type = T.TimestampType()
+        elif col in numerics or kind == "f":
+            # compacted columns are widened back to the spark types
+            if df[col].dtype != float:
+                converted[col] = pd.to_numeric(df[col], errors="coerce").astype(float)
+            spark_type = T.DoubleType()
+        elif kind in "iu":
+            if df[col].dtype != "int64":
+                converted[col] = df[col].astype("int64")
+            spark_type = T.LongType()
+        elif kind == "b":
+            spark_type = T.BooleanType()
+        else:
+            # objects and categories are kept as strings, missing values stay missing
+            values = df[col].astype(object)
+            converted[col] = values.where(values.isna(), values.astype(str))
+            spark_type = T.StringType()
+        fields.append(T.StructField(str(col), spark_type, True))
+    if converted:
+        df = df.assign(**converted)
+    return T.StructType(fields), df
+
+
+def to_spark(session, df, mapping=None, batch_size=10000):
+    """
+    converts a pandas table to spark through arrow with an explicit schema, the conversion time is logged
+    :param session: the spark session - SparkSession
+    :param df: the table - Dataframe
+    :param mapping: the content of columns_type_mapping.json, default: the stored one if it exists - dictionary
+    :param batch_size: the maximal number of rows in an arrow record batch - int
+    :return: the table - spark Dataframe
+    """
+    start = time.time()
+    arrow = configure_arrow(session, batch_size)
+    schema, df = spark_schema(df, mapping if mapping is not None else load_columns_mapping())
+    spark_df = session.createDataFrame(df, schema=schema)
+    logging.info("pandas to spark of {} took {} seconds ({})".format(df.shape, round(time.time() - start, 2),
+                                                                     "arrow" if arrow else "rows"))
+    return spark_df
+
+
+def to_pandas(spark_df, batch_size=10000):
+    """
+    collects a spark table to pandas through arrow, the conversion time is logged
+    :param spark_df: the table - spark Dataframe
+    :param batch_size: the maximal number of rows in an arrow record batch - int
+    :return: the table - Dataframe
+    """
+    start = time.time()
+    arrow = configure_arrow(spark_df.sql_ctx.sparkSession, batch_size)
+    df = spark_df.toPandas()
+    logging.info("spark to pandas of {} took {} seconds ({})".format(df.shape, round(time.time() - start, 2),
+                                                                     "arrow" if arrow else "rows"))
+    return df
+
+
+def _results_frame(X, y, split):
+    """
+    :param X: the features, indexed by the keys - Dataframe
+    :param y: the target - Series or numpy array
+    :param split: train or test - string
+    :return: the keys, the features as c0, c1, ... (parquet doesn't allow names like "col(t-1)"), y, the position of
+    the row and the split - Dataframe
+    """
+    df = X.reset_index()
+    df.columns = list(X.index.names) + ["c{}".format(i) for i in range(X.shape[1])]
+    return df.assign(y=np.asarray(y), row_position=np.arange(df.shape[0]), split=split)
+
+
+def spark_write_preprocess_results(session, target, X_train, y_train, X_test, y_test, database="preprocess_results",
+                                   batch_size=10000):
+    """
+    writes the preprocessed data of a problem as a parquet table of the catalog, partitioned by the split, so every
+    node of the cluster can read it. the names of the features are kept in a second table
+    :param session: the spark session - SparkSession
+    :param target: the name of the target - string
+    :param X_train: the train features, indexed by the keys - Dataframe
+    :param y_train: the train target - Series or numpy array
+    :param X_test: the test features, its columns are aligned to X_train - Dataframe
+    :param y_test: the test target - Series or numpy array
+    :param database: the catalog database of the tables - string
+    :param batch_size: the maximal number of rows in an arrow record batch - int
+    """
+    session.sql("create database if not exists {}".format(database))
+    X_test = X_test.reindex(columns=X_train.columns)
+    df = pd.concat([_results_frame(X_train, y_train, "train"), _results_frame(X_test, y_test, "test")],
+                   ignore_index=True)
+    to_spark(session, df, mapping={}, batch_size=batch_size).write.mode("overwrite").format("parquet") \
+        .partitionBy("split").saveAsTable("{}.data_{}".format(database, target))
+    names = pd.DataFrame({"position": np.arange(X_train.shape[1]), "name": [str(col) for col in X_train.columns]})
+    to_spark(session, names, mapping={}, batch_size=batch_size).write.mode("overwrite").format("parquet") \
+        .saveAsTable("{}.columns_{}".format(database, target))
+    logging.info("preprocess results of {} saved to {}.data_{}".format(target, database, target))
+
+
+def spark_read_preprocess_results(session, target, keys, columns=None, database="preprocess_results",
+                                  batch_size=10000):
+    """
+    reads the preprocessed data written by spark_write_preprocess_results, only the split partition and the selected
+    columns are read from the files
+    :param session: the spark session - SparkSession
+    :param target: the name of the target - string
+    :param keys: the key columns to set as the index of X - list of strings
+    :param columns: the features to read, default: all of them - list of strings
+    :param database: the catalog database of the tables - string
+    :param batch_size: the maximal number of rows in an arrow record batch - int
+    :return: X_train, y_train, X_test, y_test - tuple
+    """
+    names = to_pandas(session.table("{}.columns_{}".format(database, target)), batch_size)
+    names = names.sort_values("position")["name"].tolist()
+    selected = names if columns is None else [name for name in names if name in columns]
+    stored = ["c{}".format(names.index(name)) for name in selected]
+    table = session.table("{}.data_{}".format(database, target))
+    results = []
+    for split in ["train", "test"]:
+        spark_df = table.where(F.col("split") == split).select(*(keys + stored + ["y", "row_position"]))
+        df = to_pandas(spark_df, batch_size).sort_values("row_position")
+        X = df[keys + stored]
+        X.columns = keys + selected
+        results += [X.set_index(keys), df["y"].values]
+    return tuple(results)
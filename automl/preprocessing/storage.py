@@ -0,0 +1,175 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import numpy as np
+import pandas as pd
+
+
+def columnar_format():
+    """
+    finds the columnar format that can be used in this environment, parquet and feather both need pyarrow
+    :return: the name of the format or None if no columnar engine is installed - string
+    """
+    try:
+        import pyarrow
+        return "parquet"
+    except ImportError:
+        return None
+
+
+def _source_fingerprint(path, **kwargs):
+    """
+    creates a key that changes whenever the source file or the way it is parsed changes
+    :param path: the path of the source file - string
+    :param kwargs: the parameters used to parse the file - dictionary
+    :return: the key - string
+    """
+    stat = os.stat(path)
+    key = json.dumps([os.path.abspath(path), stat.st_size, stat.st_mtime_ns, kwargs], sort_keys=True, default=str)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+def cached_read_csv(path, cache_dir, **kwargs):
+    """
+    reads a csv file through a columnar cache, the csv is parsed only when it is not in the cache or when it changed
+    (the cache is keyed by the file path, size and modification time). the column names are stripped before caching
+    :param path: the path of the csv file - string
+    :param cache_dir: the folder to keep the columnar copies in - string
+    :param kwargs: parameters passed to pd.read_csv - dictionary
+    :return: df: the table - Dataframe
+    """
+    file_format = columnar_format()
+    if file_format is None:
+        df = pd.read_csv(path, **kwargs)
+        df.columns = [name.strip() for name in df.columns]
+        return df
+    name = os.path.splitext(os.path.basename(path))[0]
+    cache_file = os.path.join(cache_dir, "{}_{}.{}".format(name, _source_fingerprint(path, **kwargs), file_format))
+    if os.path.exists(cache_file):
+        try:
+            return pd.read_parquet(cache_file)
+        except Exception as e:
+            logging.info("can't read the cache of {}, parsing the csv again".format(path))
+            logging.info(e)
+    df = pd.read_csv(path, **kwargs)
+    df.columns = [name.strip() for name in df.columns]
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    # remove the copies of older versions of the same file
+    for file in os.listdir(cache_dir):
+        if re.match(re.escape(name) + r"_[0-9a-f]{16}\." + file_format + "$", file):
+            os.remove(os.path.join(cache_dir, file))
+    try:
+        df.to_parquet(cache_file, index=False)
+    except Exception as e:
+        logging.info("can't cache {}".format(path))
+        logging.info(e)
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+    return df
+
+
+def write_table(df, path, file_format=None):
+    """
+    writes a table in the columnar format, or as a pickle when no columnar engine is installed
+    :param df: the table to write - Dataframe
+    :param path: the path to write to, without an extension - string
+    :param file_format: parquet or feather, feather is written uncompressed so it can be memory mapped, default: the
+    columnar format - string
+    :return: the path of the written file - string
+    """
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    if columnar_format() is None:
+        df.to_pickle(path + ".p")
+        return path + ".p"
+    file_format = file_format or columnar_format()
+    if file_format == "feather":
+        from pyarrow import feather
+        feather.write_feather(df, path + ".feather", compression="uncompressed")
+    else:
+        df.to_parquet(path + "." + file_format, index=False)
+    return path + "." + file_format
+
+
+def read_table(path, memory_map=True):
+    """
+    reads a table written by write_table
+    :param path: the path of the file, with or without the extension - string
+    :param memory_map: if a feather file is memory mapped instead of read, the columns are converted without copying
+    when arrow can - boolean
+    :return: the table - Dataframe
+    """
+    if not os.path.exists(path):
+        path = [path + ext for ext in ["." + str(columnar_format()), ".feather", ".p"] if os.path.exists(path + ext)][0]
+    if path.endswith(".p"):
+        return pd.read_pickle(path)
+    if path.endswith(".feather"):
+        from pyarrow import feather
+        return feather.read_table(path, memory_map=memory_map).to_pandas(split_blocks=True)
+    return pd.read_parquet(path)
+
+
+def read_tables(folder, prefix="part-"):
+    """
+    reads all the parts written to a folder by write_table, in the order of their names
+    :param folder: the folder of the parts - string
+    :param prefix: the prefix of the parts file names - string
+    :return: the parts concatenated - Dataframe
+    """
+    files = sorted(file for file in os.listdir(folder) if file.startswith(prefix))
+    return pd.concat([read_table(os.path.join(folder, file)) for file in files], ignore_index=True)
+
+
+def write_preprocess_results(target, X_train, y_train, X_test, y_test, folder="preprocess_results"):
+    """
+    writes the preprocessed data of a problem as uncompressed feather files (a pickle without pyarrow), the keys of X
+    are kept as columns and the column names as strings, like the csv files that were written before
+    :param target: the name of the target - string
+    :param X_train: the train features - Dataframe
+    :param y_train: the train target - Series or numpy array
+    :param X_test: the test features - Dataframe
+    :param y_test: the test target - Series or numpy array
+    :param folder: the folder of the results - string
+    """
+    tables = {"X_train": X_train.reset_index(), "y_train": pd.DataFrame({target: np.asarray(y_train)}),
+              "X_test": X_test.reset_index(), "y_test": pd.DataFrame({target: np.asarray(y_test)})}
+    for name, df in tables.items():
+        write_table(df.rename(columns=str), os.path.join(folder, "{}_{}".format(name, target)), "feather")
+
+
+def read_preprocess_results(target, keys, folder="preprocess_results"):
+    """
+    reads the preprocessed data written by write_preprocess_results, the feather files are memory mapped
+    :param target: the name of the target - string
+    :param keys: the key columns to set as the index of X - list of strings
+    :param folder: the folder of the results - string
+    :return: X_train, y_train, X_test, y_test - tuple
+    """
+    X_train = read_table(os.path.join(folder, "X_train_{}".format(target))).set_index(keys)
+    y_train = read_table(os.path.join(folder, "y_train_{}".format(target))).values.flatten()
+    X_test = read_table(os.path.join(folder, "X_test_{}".format(target))).set_index(keys)
+    y_test = read_table(os.path.join(folder, "y_test_{}".format(target))).values.flatten()
+    return X_train, y_train, X_test, y_test
+
+
+def float32_matrix(df, path, block_size=65536):
+    """
+    writes the values of a table as a float32 C-contiguous matrix to a .npy file and memory maps it back, so all the
+    models, cv folds and joblib workers (joblib passes memory maps by their file) read the same pages instead of their
+    own copies
+    :param df: the numeric table - Dataframe
+    :param path: the path of the .npy file - string
+    :param block_size: the number of rows converted at once, so there is no float64 copy of the whole table - int
+    :return: the read only matrix - numpy memmap
+    """
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    matrix = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=df.shape)
+    for start in range(0, df.shape[0], block_size):
+        matrix[start:start + block_size] = df.iloc[start:start + block_size].values.astype(np.float32)
+    matrix.flush()
+    del matrix
+    return np.load(path, mmap_mode="r")
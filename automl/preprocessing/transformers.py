@@ -10,6 +10,13 @@ import numpy as np
 import networkx
 import os
 import multiprocessing as mp
+import functools
+try:
+    import resource
+except ImportError:
+    # there is no resource module on windows, the peak memory is not measured there
+    resource = None
+import time
 from sklearn.feature_selection import chi2
 # for stop seeing unnecessary messages
 pd.options.mode.chained_assignment = None
@@ -62,16 +69,124 @@ def doing(key, key_field, date_field, fill_end):
     lock.release()
 
 
+def _peak_rss():
+    """
+    :return: the peak resident memory of the process so far in bytes (ru_maxrss is in kilobytes on linux), None when
+    it can't be measured - int
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _data_size(data):
+    """
+    :param data: the input or output of a stage - Dataframe, Series, numpy array or another object
+    :return: the shape and the size in bytes of the data, None when it has none - tuple
+    """
+    if isinstance(data, pd.DataFrame):
+        return list(data.shape), int(data.memory_usage(index=True).sum())
+    if isinstance(data, (pd.Series, np.ndarray)):
+        return list(data.shape), int(data.nbytes)
+    return None, None
+
+
+def _key_values(X, col):
+    """
+    :param X: the data - Dataframe
+    :param col: a column or a level of the index of X - string
+    :return: the values of the column - numpy array
+    """
+    if col in X.columns:
+        return X[col].values
+    return X.index.get_level_values(col).values
+
+
+def _instrumented(method):
+    """
+    wraps fit or transform of a CustomTransformer to add a record of the call to the stage_report of the instance,
+    calls through super() are part of the outer call and are not recorded
+    :param method: the fit or transform method - function
+    :return: the wrapped method - function
+    """
+    @functools.wraps(method)
+    def wrapper(self, X, *args, **kwargs):
+        if getattr(self, "_measuring", False):
+            return method(self, X, *args, **kwargs)
+        self._measuring = True
+        wall, cpu, peak = time.time(), time.process_time(), _peak_rss()
+        try:
+            result = method(self, X, *args, **kwargs)
+        finally:
+            self._measuring = False
+        input_shape, input_bytes = _data_size(X)
+        output_shape, output_bytes = _data_size(result)
+        if "stage_report" not in self.__dict__:
+            self.stage_report = []
+        self.stage_report.append(
+            {"stage": type(self).__name__, "method": method.__name__, "wall_seconds": time.time() - wall,
+             "cpu_seconds": time.process_time() - cpu, "peak_rss_delta": None if peak is None else _peak_rss() - peak,
+             "input_shape": input_shape, "input_bytes": input_bytes, "output_shape": output_shape,
+             "output_bytes": output_bytes})
+        if len(self.stage_report) > self.report_size:
+            # the fit records are kept and the oldest of the other records is dropped
+            oldest = next((i for i, record in enumerate(self.stage_report) if record["method"] != "fit"), 0)
+            self.stage_report.pop(oldest)
+        return result
+    wrapper._instrumented = True
+    return wrapper
+
+
 class CustomTransformer(BaseEstimator, TransformerMixin):
     """
-    a general class for creating a machine learning step in the machine learning pipeline
+    a general class for creating a machine learning step in the machine learning pipeline.
+    the fit and transform methods of every subclass are measured, the wall time, cpu time, growth of the peak memory
+    of the process and the shape and bytes of the input and output of every fit and of the last other calls (up to
+    report_size records) are kept in stage_report, which is not pickled with the stage.
+    transform copies the data it changes, unless copy_input is turned off by a pipeline that owns the data.
+    transform_stream is transform over chunks of the data, the stages that depend on the rows of the same key carry
+    them from chunk to chunk
     """
+    copy_input = True
+    report_size = 100
+
     def __init__(self):
         """
         constructor
         """
         super(CustomTransformer, self).__init__()
 
+    def __getstate__(self):
+        state = dict(super(CustomTransformer, self).__getstate__())
+        # the report is of the calls in this process
+        state.pop("stage_report", None)
+        state.pop("_measuring", None)
+        return state
+
+    def _own(self, X):
+        """
+        :param X: the data the transform changes - Dataframe
+        :return: a copy of X, or X itself when the pipeline owns it - Dataframe
+        """
+        return X.copy(True) if self.copy_input else X
+
+    def transform_stream(self, chunks):
+        """
+        transform over chunks of the data, every chunk is transformed by itself
+        :param chunks: features - iterator of Dataframes
+        :return: the transformed chunks - generator of Dataframes
+        """
+        for chunk in chunks:
+            yield self.transform(chunk)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in ["fit", "transform"]:
+            method = cls.__dict__.get(name)
+            if method is not None and not getattr(method, "_instrumented", False):
+                setattr(cls, name, _instrumented(method))
+
     def fit(self, X, y=None, **kwargs):
         """
         an abstract method that is used to fit the step and to learn by examples
@@ -100,7 +215,7 @@ class CustomTransformer(BaseEstimator, TransformerMixin):
         :param kwargs: free parameters - dictionary
         :return: X: the transformed data - Dataframe
         """
-        self = self.fit(X, y)
+        self = self.fit(X, y, **kwargs)
         return self.transform(X, y)
 
 
@@ -108,13 +223,16 @@ class ClearNoCategoriesTransformer(CustomTransformer):
     """
     transformer that remove categorical features with no variance
     """
-    def __init__(self, categorical_cols=[]):
+    def __init__(self, categorical_cols=[], profile=None):
         """
         constructor
         :param categorical_cols: the categoric columns to transform - list
+        :param profile: the profile of the data the transformer is fitted on (see automl.profiler), the profiled
+        columns are removed by their distinct count without scanning them - dictionary
         """
         super(ClearNoCategoriesTransformer, self).__init__()
         self.categorical_cols = categorical_cols
+        self.profile = profile
         self.remove = []
         self._columns = None
 
@@ -124,7 +242,10 @@ class ClearNoCategoriesTransformer(CustomTransformer):
         :param df: the Dataframe to check - Dataframe
         :param col: the column to check in the Dataframe - string
         """
-        if df[col].unique().shape[0] == 1:
+        if self.profile is not None and col in self.profile:
+            if self.profile[col]["distinct"] == 1:
+                self.remove.append(col)
+        elif df[col].unique().shape[0] == 1:
             self.remove.append(col)
 
     def fit(self, X, y=None, **kwargs):
@@ -137,17 +258,13 @@ class ClearNoCategoriesTransformer(CustomTransformer):
         """
         # remember the origianl features
         self._columns = X.columns
-        try:
-            df = X.copy(True)
-        except Exception as e:
-            raise e
         try:
             if len(self.categorical_cols) > 0:
                 cols = self.categorical_cols
             else:
-                cols = df.columns
+                cols = X.columns
             for col in cols:
-                self._clear(df, col)
+                self._clear(X, col)
         except Exception as e:
             logging.info(e)
         logging.info("ClearNoCategoriesTransformer fit end")
@@ -203,6 +320,10 @@ class ImputeTransformer(CustomTransformer):
         """
         self.numerical_cols = [col for col in self.numerical_cols if col in X.columns]
         self.categorical_cols = [col for col in self.categorical_cols if col in X.columns]
+        # the columns with missing values in the fit get an indicator in the transform, the indicators are categorical
+        self.indicators = [col + '_was_missing' for col in self.numerical_cols if X[col].isnull().any()]
+        self.categorical_cols = self.categorical_cols + [col for col in self.indicators
+                                                         if col not in self.categorical_cols]
         if self.strategy not in ["time_series", "zero"]:
             self.imp = SimpleImputer(strategy=self.strategy)
             self.imp.fit(X[self.numerical_cols])
@@ -223,9 +344,10 @@ class ImputeTransformer(CustomTransformer):
         for col in self.numerical_cols:
             nulls = X[col].isnull()
             missing_ind_name = col + '_was_missing'
-            if sum(nulls) > 0:
-                self.categorical_cols.append(missing_ind_name)
+            if missing_ind_name in self.indicators:
+                # the indicators of the fit even when X has no missing values, so every chunk has the same columns
                 X[missing_ind_name] = nulls.values
+            if sum(nulls) > 0:
                 if self.strategy == "zero":
                     X[col].fillna(0, inplace=True)
                 if self.strategy == "negative":
@@ -270,6 +392,31 @@ class ImputeTransformer(CustomTransformer):
         logging.info("ImputeTransformer transform end")
         return X
 
+    def transform_stream(self, chunks):
+        """
+        transform over chunks ordered by key and date. with the time_series strategy the missing values are filled
+        from the other rows of the key, so the rows of the last key of a chunk are held back and transformed with the
+        next chunk, where the key may continue
+        :param chunks: features - iterator of Dataframes
+        :return: the transformed chunks, of whole keys - generator of Dataframes
+        """
+        if self.strategy != "time_series":
+            yield from super(ImputeTransformer, self).transform_stream(chunks)
+            return
+        held = None
+        for chunk in chunks:
+            if chunk.shape[0] == 0:
+                continue
+            if held is not None:
+                chunk = pd.concat([held, chunk])
+            keys = _key_values(chunk, self.key_field)
+            last = keys == keys[-1]
+            held = chunk[last]
+            if not last.all():
+                yield self.transform(chunk[~last])
+        if held is not None:
+            yield self.transform(held)
+
 
 class OutliersTransformer(CustomTransformer):
     """
@@ -304,6 +451,7 @@ class OutliersTransformer(CustomTransformer):
         self.categorical_cols = categorical_cols
         self.outliers = None
         self.cols_borders = dict()
+        self.cols_clip = dict()
         self.magnitude = magnitude
 
     @staticmethod
@@ -415,6 +563,10 @@ class OutliersTransformer(CustomTransformer):
                     logging.info(e)
                 self.cols_borders[col] = dict(min_v=-self.magnitude * iqr + descriptive["50%"],
                                               max_v=self.magnitude * iqr + descriptive["50%"])
+                # the extremes inside the borders, transform_stream clips to them
+                col_df = X[(X[col] > self.cols_borders[col]["min_v"]) & (X[col] < self.cols_borders[col]["max_v"])][col].dropna()
+                if col_df.shape[0] != 0:
+                    self.cols_clip[col] = dict(min_v=col_df.min(), max_v=col_df.max())
             logging.info("OutliersTransformer fit end")
             return self
         else:
@@ -423,6 +575,17 @@ class OutliersTransformer(CustomTransformer):
             self.outliers = {col: self._hdbscan(X, col) for col in self.numerical_cols}
             logging.info("OutliersTransformer fit end")
 
+    def _replace_inf(self, X):
+        """
+        replaces the infinite values in place, the std of a column with an infinite value is nan so they become nan
+        :param X: the data - Dataframe
+        """
+        for col in self.numerical_cols:
+            m = X.loc[X[col] != np.inf, col].max() + X[col].std()
+            X[col].replace(np.inf, m, inplace=True)
+            m = X.loc[X[col] != np.NINF, col].min() + X[col].std()
+            X[col].replace(np.NINF, m, inplace=True)
+
     def _iqr(self, x, min_v, max_v, col):
 
         if x > self.cols_borders[col]["max_v"]:
@@ -441,11 +604,7 @@ class OutliersTransformer(CustomTransformer):
         :return: X: the transformed data - Dataframe
         """
         # X = X.copy(True)
-        for col in self.numerical_cols:
-            m = X.loc[X[col] != np.inf, col].max() + X[col].std()
-            X[col].replace(np.inf, m, inplace=True)
-            m = X.loc[X[col] != np.NINF, col].min() + X[col].std()
-            X[col].replace(np.NINF, m, inplace=True)
+        self._replace_inf(X)
         if self.strategy == "iqr":
             cols_to_iterate = [col for col in self.numerical_cols if col in X.columns]
             for col in cols_to_iterate:
@@ -466,6 +625,27 @@ class OutliersTransformer(CustomTransformer):
         logging.info("OutliersTransformer transform end")
         return X
 
+    def transform_stream(self, chunks):
+        """
+        transform over chunks of the data. transform clips the outliers to the extremes of the data it transforms, that
+        are not known before the end of a stream, so with the iqr strategy the chunks are clipped to the extremes of
+        the data of the fit
+        :param chunks: features - iterator of Dataframes
+        :return: the transformed chunks - generator of Dataframes
+        """
+        if self.strategy != "iqr":
+            yield from super(OutliersTransformer, self).transform_stream(chunks)
+            return
+        for chunk in chunks:
+            X = self._own(chunk)
+            self._replace_inf(X)
+            cols_to_iterate = [col for col in self.numerical_cols if col in X.columns and col in self.cols_clip]
+            for col in cols_to_iterate:
+                clip = self.cols_clip[col]
+                X[col] = X[col].apply(lambda x: self._iqr(x, clip["min_v"], clip["max_v"], col))
+            logging.info("OutliersTransformer transform end")
+            yield X
+
 
 class ScalingTransformer(CustomTransformer):
     """
@@ -506,12 +686,14 @@ class ScalingTransformer(CustomTransformer):
         :return: df: the transformed data - Dataframe
         """
         cols_to_complete = [col for col in self.columns if col not in X.columns]
-        df = X.copy(True)
+        cols = [col for col in self.numerical_cols if col in X.columns or col in cols_to_complete]
+        # scaled before the columns are completed, X may be changed in place
+        scaled = self.scaler.transform(X[cols]) if len(cols) > 0 else None
+        df = self._own(X)
         for col in cols_to_complete:
             df[col] = 0
-        cols = [col for col in self.numerical_cols if col in df.columns]
         if len(cols) > 0:
-            df[cols] = self.scaler.transform(X[cols])
+            df[cols] = scaled
         logging.info("ScalingTransformer transform end")
         return df
 
@@ -530,6 +712,7 @@ class CategorizingTransformer(CustomTransformer):
         super(CategorizingTransformer, self).__init__()
         self.categorical_cols = categorical_cols
         self.threshold = threshold
+        self.levels = None
 
     def _frequency_table(self, df, col, ind=True, transform=True, cut=True):
         """
@@ -570,23 +753,6 @@ class CategorizingTransformer(CustomTransformer):
 
         return df_return
 
-    @staticmethod
-    def _change(x, temp, frq_test, col):
-        """
-        changing the values
-        :param x: the value to change - string
-        :param temp: the temporary dictionary to use for tansforming - dictionary
-        :param frq_test: the frequnecy table created with _frequency_table method - Dataframe
-        :param col: the column to check for values in - string
-        :return: the class or "other" if it was merged - string
-        """
-        if str(x).lower() in frq_test[col].tolist():
-            temp[x] = x
-            return x
-        else:
-            temp[x] = "other"
-            return "other"
-
     def fit(self, X, y=None, **kwargs):
         """
         learning from the X dataframe what class to keep in which to join together in each column specified
@@ -597,6 +763,9 @@ class CategorizingTransformer(CustomTransformer):
         """
         self.categorical_cols = [col for col in X.columns if col in self.categorical_cols or "_was_missing" in col or
                                  "_has_outliers" in col]
+        # the classes that are kept in each column, the others are joined to "other" in the transform
+        self.levels = {col: self._frequency_table(X, col, True, False, False)[col].tolist()
+                       for col in self.categorical_cols}
         logging.info("CategorizingTransformer fit end")
         return self
 
@@ -608,21 +777,14 @@ class CategorizingTransformer(CustomTransformer):
         :param kwargs: free parameters - dictionary
         :return: X: the transformed data - Dataframe
         """
-        X_copy = X.copy(True)
-        cat_dic = {}
-        temp = {}
+        X_copy = self._own(X)
         columns = X_copy.columns
-
         for col in self.categorical_cols:
             if col not in columns:
                 X_copy[col] = "other"
             else:
-                frq_test = self._frequency_table(X, col, True, False, False)
-                X_copy[col] = X[col].apply(lambda x: self._change(x, temp, frq_test, col))
-                cat_dic[col] = temp
-                temp = {}
-
-        self.categorical_cols = cat_dic
+                kept = X[col].astype(str).str.lower().isin(self.levels[col])
+                X_copy[col] = X[col].where(kept, "other")
         logging.info("CategorizingTransformer transform end")
         return X_copy
 
@@ -689,7 +851,8 @@ class CategorizeByTargetTransformer(CustomTransformer):
         """
         self.categorical_cols = [col for col in X.columns if col in self.categorical_cols or "_was_missing" in col or
                                  "_has_outliers" in col]
-        df = X.copy(True)
+        # only the categorical columns are used and changed
+        df = X[self.categorical_cols].copy(True)
         df[self.categorical_cols].fillna('nan', inplace=True)
 
         for col in self.categorical_cols:
@@ -742,7 +905,7 @@ class CategorizeByTargetTransformer(CustomTransformer):
         """
         cols = [col for col in X.columns if col in self.categorical_cols or "_was_missing" in col or
                 "_has_outliers" in col]
-        df = X.copy()
+        df = self._own(X)
         df[cols].fillna('nan', inplace=True)
         for col in self.names.keys():
             keys = self.names[col].keys()
@@ -1006,7 +1169,7 @@ class DummiesTransformer(CustomTransformer):
         """
         self.categorical_cols = [col for col in X.columns if col in self.categorical_cols or "_was_missing" in col or
                                  "_has_outliers" in col]
-        df = X.copy(True)
+        df = X
         try:
             df = pd.concat([df.drop(self.categorical_cols, axis=1), pd.get_dummies(data=df[self.categorical_cols],
                                                                                    columns=self.categorical_cols,
@@ -1017,19 +1180,21 @@ class DummiesTransformer(CustomTransformer):
         logging.info("DummiesTransformer fit end")
         return self
 
-    def transform(self, X, y=None, **kwargs):
+    def transform(self, X, y=None, drop_first=True, **kwargs):
         """
         transform each category for each categorical column to a new dummy column
         :param X: features - Dataframe
         :param y: target vector - Series
+        :param drop_first: if the first category in X is dropped, else only the categories dropped in the fit are
+        missing from the output - boolean
         :param kwargs: free parameters - dictionary
         :return: df: the transformed data - Dataframe
         """
         cols = [col for col in self.categorical_cols if col in X.columns]
-        df = X.copy(True)
         if len(cols) > 0:
-            df = pd.concat([df.drop(cols, axis=1),
-                            pd.get_dummies(data=df[cols], columns=cols, drop_first=True)], axis=1)
+            # concat makes a new frame so X is not copied
+            df = pd.concat([X.drop(cols, axis=1),
+                            pd.get_dummies(data=X[cols], columns=cols, drop_first=drop_first)], axis=1)
             cols_out = [col for col in df.columns if col in self.cols_name_after]
             cols_complete = [col for col in self.cols_name_after if col not in df.columns]
             df = df[cols_out]
@@ -1041,7 +1206,21 @@ class DummiesTransformer(CustomTransformer):
             return df[self.final_cols]
         else:
             logging.info("DummiesTransformer transform end")
-            return df
+            return self._own(X)
+
+    def transform_stream(self, chunks):
+        """
+        transform over chunks of the data. the first category of a chunk is not always the one dropped in the fit, so
+        no category is dropped and the columns of the fit are kept. the categories that are not in a chunk are
+        completed as uint8 like the other dummies, so all the chunks have the same dtypes
+        :param chunks: features - iterator of Dataframes
+        :return: the transformed chunks - generator of Dataframes
+        """
+        for chunk in chunks:
+            X = self.transform(chunk, drop_first=False)
+            dummies = [col for col in X.columns if col not in chunk.columns]
+            X[dummies] = X[dummies].astype(np.uint8)
+            yield X
 
 
 def time_series_parallel_unpack(args):
@@ -1139,6 +1318,39 @@ class TimeSeriesTransformer(CustomTransformer):
             logging.info("TimeSeriesTransformer transform end")
             return df
 
+    def _rows(self, X):
+        """
+        :param X: the data - Dataframe
+        :return: the (key, date) of every row - list of tuples
+        """
+        return list(zip(_key_values(X, self.key), _key_values(X, self.date)))
+
+    def transform_stream(self, chunks):
+        """
+        transform over chunks ordered by key and date. the lags of the first rows of a key need its w rows before them
+        and the forecast columns of its last rows need the r - 1 rows after them, so the last w + r - 1 rows of the
+        last key of a chunk are carried to the next chunk: the rows that were already transformed are dropped from
+        the output and the last r - 1 ones are transformed only with the rows after them
+        :param chunks: features - iterator of Dataframes
+        :return: the transformed chunks - generator of Dataframes
+        """
+        carried, done = None, []
+        for chunk in chunks:
+            if chunk.shape[0] == 0:
+                continue
+            if carried is not None:
+                chunk = pd.concat([carried, chunk])
+            df = self.transform(chunk)
+            keys = _key_values(chunk, self.key)
+            last = chunk[keys == keys[-1]]
+            pending = set(self._rows(last.iloc[max(last.shape[0] - self.r + 1, 0):])) if self.r > 1 else set()
+            yield df[~df.index.isin(done + list(pending))]
+            carried = last.iloc[max(last.shape[0] - self.w - self.r + 1, 0):]
+            done = [row for row in self._rows(carried) if row not in pending]
+        if carried is not None and self.r > 1:
+            df = self.transform(carried)
+            yield df[~df.index.isin(done)]
+
 
 class FeatureSelectionTransformer(CustomTransformer):
     """
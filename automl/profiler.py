@@ -0,0 +1,184 @@
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+
+class HyperLogLog:
+    """
+    hyperloglog distinct counter over 64 bit hashes, the registers are updated for a whole array of hashes at once.
+    while the number of distinct hashes is small they are also kept exactly so low cardinalities are exact
+    """
+    def __init__(self, precision=14, exact_limit=1024):
+        """
+        constructor
+        :param precision: the number of bits of the register index, the error is about 1.04 / sqrt(2 ** precision) -
+        int
+        :param exact_limit: the number of distinct values to count exactly before relying on the registers - int
+        """
+        self.precision = precision
+        self.m = 2 ** precision
+        self.registers = np.zeros(self.m, dtype=np.uint8)
+        self.exact_limit = exact_limit
+        self.exact = set()
+
+    def add(self, hashes):
+        """
+        :param hashes: the 64 bit hashes of the values - numpy array of uint64
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if self.exact is not None:
+            self.exact.update(np.unique(hashes).tolist())
+            if len(self.exact) > self.exact_limit:
+                self.exact = None
+        bits = 64 - self.precision
+        index = (hashes >> np.uint64(bits)).astype(np.int64)
+        rest = hashes & np.uint64((1 << bits) - 1)
+        # the position of the first 1 bit in the rest of the hash, the rest has less than 53 bits so log2 is exact
+        rank = np.full(hashes.shape[0], bits + 1, dtype=np.uint8)
+        nonzero = rest > 0
+        rank[nonzero] = bits - np.floor(np.log2(rest[nonzero].astype(np.float64))).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other):
+        """
+        :param other: a counter with the same precision - HyperLogLog
+        """
+        self.registers = np.maximum(self.registers, other.registers)
+        if self.exact is not None and other.exact is not None and len(self.exact | other.exact) <= self.exact_limit:
+            self.exact |= other.exact
+        else:
+            self.exact = None
+
+    def count(self):
+        """
+        :return: the estimated number of distinct values - int
+        """
+        if self.exact is not None:
+            return len(self.exact)
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m ** 2 / np.sum(2.0 ** -self.registers.astype(np.float64))
+        zeros = int(np.sum(self.registers == 0))
+        if estimate <= 2.5 * self.m and zeros > 0:
+            # linear counting is more accurate for small cardinalities
+            estimate = self.m * np.log(self.m / zeros)
+        return int(round(estimate))
+
+
+class ColumnProfiler:
+    """
+    single pass profiler of a table that is read in chunks, keeps per column the number of rows and nulls, a distinct
+    counter, the min and max of numeric columns and if the values of object columns can be parsed as dates
+    """
+    def __init__(self, precision=14, exact_limit=1024, date_sample=1000):
+        """
+        constructor
+        :param precision: the precision of the distinct counters - int
+        :param exact_limit: the number of distinct values that are counted exactly - int
+        :param date_sample: the maximal number of unique values of a chunk that are parsed as dates - int
+        """
+        self.precision = precision
+        self.exact_limit = exact_limit
+        self.date_sample = date_sample
+        self.columns = {}
+
+    def _column(self, col):
+        if col not in self.columns:
+            self.columns[col] = {"rows": 0, "nulls": 0, "min": None, "max": None, "object": False,
+                                 "date_checked": 0, "date_failures": 0, "parsed": set(),
+                                 "distinct": HyperLogLog(self.precision, self.exact_limit)}
+        return self.columns[col]
+
+    def update(self, df):
+        """
+        adds a chunk of the table to the profile
+        :param df: the chunk - Dataframe
+        :return: self - ColumnProfiler
+        """
+        for col in df.columns:
+            stats = self._column(col)
+            values = df[col]
+            nulls = values.isna()
+            stats["rows"] += values.shape[0]
+            stats["nulls"] += int(nulls.sum())
+            # -0.0 is hashed differently than 0.0 but is the same value
+            hashed = values + 0.0 if values.dtype.kind == "f" else values
+            stats["distinct"].add(pd.util.hash_pandas_object(hashed, index=False).values)
+            if values.dtype.kind in "O" or str(values.dtype) == "category" or values.dtype.kind == "b":
+                stats["object"] = True
+                self._update_dates(stats, values)
+            elif values.dtype.kind in "iuf" and not nulls.all():
+                low, high = float(values.min()), float(values.max())
+                stats["min"] = low if stats["min"] is None else min(stats["min"], low)
+                stats["max"] = high if stats["max"] is None else max(stats["max"], high)
+        return self
+
+    def _update_dates(self, stats, values):
+        """
+        parses the unique values of the chunk that were not parsed before (up to date_sample of them)
+        :param stats: the statistics of the column - dictionary
+        :param values: the chunk of the column - Series
+        """
+        uniques = values.astype(object).fillna(0).unique()
+        if stats["parsed"] is not None:
+            uniques = [value for value in uniques if value not in stats["parsed"]]
+        uniques = uniques[:self.date_sample]
+        if len(uniques) == 0:
+            return
+        parsed = pd.to_datetime(pd.Series(uniques, dtype=object), errors="coerce")
+        stats["date_checked"] += len(uniques)
+        stats["date_failures"] += int(parsed.isna().sum())
+        if stats["parsed"] is not None:
+            stats["parsed"].update(uniques)
+            if len(stats["parsed"]) > self.exact_limit:
+                stats["parsed"] = None
+
+    def profile(self, string_ratio=0.02):
+        """
+        :param string_ratio: the ratio of values that can't be parsed that makes an object column not a date, as in
+        is_date - float
+        :return: profile: per column the rows, nulls, null_rate, distinct, min, max, object and date_like, can be saved
+        as json - dictionary
+        """
+        profile = {}
+        for col, stats in self.columns.items():
+            failures, checked = stats["date_failures"], stats["date_checked"]
+            profile[col] = {"rows": stats["rows"], "nulls": stats["nulls"],
+                            "null_rate": stats["nulls"] / stats["rows"] if stats["rows"] else 0.0,
+                            "distinct": stats["distinct"].count(), "min": stats["min"], "max": stats["max"],
+                            "object": stats["object"],
+                            "date_like": stats["object"] and checked > 0 and
+                                         (failures == 0 or (failures + 1) / checked < string_ratio)}
+        return profile
+
+
+def profile_csv(path, chunk_size=100000, **kwargs):
+    """
+    profiles a csv file without loading it to memory
+    :param path: the path of the csv - string
+    :param chunk_size: the number of rows to read at once - int
+    :param kwargs: parameters passed to pd.read_csv - dictionary
+    :return: profile: the profile of ColumnProfiler - dictionary
+    """
+    profiler = ColumnProfiler()
+    for chunk in pd.read_csv(path, chunksize=chunk_size, **kwargs):
+        profiler.update(chunk)
+    profile = profiler.profile()
+    logging.info("profiled {} columns of {}".format(len(profile), path))
+    return profile
+
+
+def save_profile(profile, path):
+    """
+    :param profile: the profile to save - dictionary
+    :param path: the path of the json file - string
+    """
+    json.dump(profile, open(path, "w"))
+
+
+def load_profile(path):
+    """
+    :param path: the path of the json file - string
+    :return: profile - dictionary
+    """
+    return json.loads(open(path).read())
@@ -1,5 +1,4 @@
 import sys
-import random
 sys.path.append("/automl")
 from automl.model_run import *
 import pandas as pd
@@ -41,20 +40,14 @@ if __name__ == "__main__":
             print("finish get cols")
             columns["key"] = key_cols
             json.dump(columns, open("columns_type_mapping.json", "w"))
+            # the accounts are split once by their hash, the same for all the problems and runs
+            train_rows, test_rows = split_by_key(df[key_cols[0]], params["train_test_per"], params["split_seed"])
         for i, p in enumerate(problems):
             if not data_ready:
                 columns["target"] = [p["target"]]
-                accounts_train, accounts_test = [], []
-                for account in df[key_cols[0]].unique():
-                    rand = random.random()
-                    if rand < params["train_test_per"]:
-                        accounts_train.append(account)
-                    else:
-                        accounts_test.append(account)
-                df_train = df[df[key_cols[0]].isin(accounts_train)].set_index(key_cols)[
-                    columns["numeric"] + columns["categoric"] + columns["target"]]
-                df_test = df[df[key_cols[0]].isin(accounts_test)].set_index(key_cols)[
-                    columns["numeric"] + columns["categoric"] + columns["target"]]
+                df_problem = df.set_index(key_cols)[columns["numeric"] + columns["categoric"] + columns["target"]]
+                df_train = df_problem.iloc[train_rows]
+                df_test = df_problem.iloc[test_rows]
                 X_train = df_train.drop(p["target"], axis=1)
                 y_train = df_train[p["target"]]
                 X_test = df_test.drop(p["target"], axis=1)
@@ -130,8 +123,7 @@ if __name__ == "__main__":
             else:
                 file = "/results/{}/".format(p["target"])
                 model = load_model(file)
-        X_train = pd.read_csv("preprocess_results/X_train_{}.csv".format(p["target"])).set_index(key_cols)
-        X_test = pd.read_csv("preprocess_results/X_train_{}.csv".format(p["target"])).set_index(key_cols)
+        X_train, _, X_test, _ = read_preprocess_results(p["target"], key_cols)
         data = pd.concat([X_train, X_test])
         if to_predict:
             result = pd.DataFrame(model.predict(data))